@@ -1,17 +1,22 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 import os
+import json
 import shutil
-from speechlib import Transcriptor
+import logging
+import tempfile
+from speechlib import Transcriptor, JobQueue, QueueFull, prometheus_text, result_cache_stats
 import torch
-import requests
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("main")
 
 # Check GPU availability
 if not torch.cuda.is_available():
-    print("GPU not available. Ensure the instance has GPU support and the correct CUDA libraries are installed.")
+    logger.warning("GPU not available. Ensure the instance has GPU support and the correct CUDA libraries are installed.")
 else:
-    print(f"Using GPU: {torch.cuda.get_device_name(0)}")
+    logger.info("Using GPU: %s", torch.cuda.get_device_name(0))
 
 app = FastAPI()
 
@@ -28,56 +33,118 @@ VOICES_FOLDER = "voices/"
 ACCESS_TOKEN = os.getenv("HF_ACCESS_TOKEN")
 AAI_API_KEY = os.getenv("AAI_API_KEY")
 
-@app.post("/transcribe/")
-async def transcribe_audio(file: UploadFile = File(...)):
+# huggingface id or local directory of the pyannote pipeline (None = pyannote/speaker-diarization@2.1)
+DIARIZATION_MODEL = os.getenv("DIARIZATION_MODEL")
+
+# retries and re-uploads of the same recording are answered from this cache ("" disables it)
+RESULT_CACHE = os.getenv("RESULT_CACHE_DIR", os.path.join(".speechlib_cache", "results")) or None
+
+# diarization of every upload is kept so reprocessing it with other settings skips pyannote ("" disables it)
+DIARIZATION_CACHE = os.getenv("DIARIZATION_CACHE_DIR", os.path.join(".speechlib_cache", "diarization")) or None
+
+# background workers that run transcriptions, and how many uploads may wait for them
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", 16))
+UPLOAD_FOLDER = "temp"
+
+# files written segment by segment while a job runs, listed in /jobs/{job_id} (comma separated, "" for none)
+OUTPUT_FORMATS = [output_format for output_format in os.getenv("OUTPUT_FORMATS", "jsonl").split(",") if output_format]
+
+def run_job(job):
+    transcriptor = Transcriptor(job.file_path, LOG_FOLDER, LANGUAGE, MODEL_SIZE, ACCESS_TOKEN, VOICES_FOLDER, QUANTIZATION, DIARIZATION_MODEL, result_cache=RESULT_CACHE, diarization_cache=DIARIZATION_CACHE, outputs=OUTPUT_FORMATS)
+    # the paths show up in the job status as soon as the files are opened
+    job.outputs = transcriptor.output_paths
+
+    # segments are published as they are transcribed, for /jobs/{job_id}/events
+    stream = transcriptor.stream("assemblyAI", aai_api_key=AAI_API_KEY)
+    for segment in stream:
+        job.add_segment(segment)
+    return stream.result
+
+jobs = JobQueue(run_job, workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS)
+
+@app.on_event("startup")
+def load_models():
+    # load one diarization pipeline per job worker once instead of on every request
+    Transcriptor.preload(ACCESS_TOKEN, DIARIZATION_MODEL, jobs.replicas)
+    jobs.start()
+
+@app.on_event("shutdown")
+def stop_workers():
+    jobs.shutdown(wait=False)
+
+@app.get("/metrics")
+def metrics():
+    # stage timings and counters in the Prometheus text format
+    return PlainTextResponse(prometheus_text(), media_type="text/plain; version=0.0.4")
+
+@app.post("/transcribe/", status_code=202)
+def transcribe_audio(file: UploadFile = File(...)):
     """
-    Endpoint to transcribe an audio file using the Transcriptor class.
-    Accepts a WAV file and returns the transcription as text.
+    Endpoint to queue the transcription of a WAV file.
+    Returns the job id right away, the result is read from /jobs/{job_id}.
     """
-    
+
     # Validate the file type
     if not file.filename.endswith(".wav"):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a .wav file.")
 
-    # Save the uploaded file temporarily
-    file_path = f"temp/{file.filename}"
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # refuse early instead of storing an upload that can not be queued
+    if jobs.full:
+        raise HTTPException(status_code=503, detail="Too many queued transcriptions, retry later.", headers={"Retry-After": "30"})
 
-    with open(file_path, "wb") as temp_file:
+    # Save the uploaded file under a unique name so uploads with the same name never collide
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(file.filename))[0]
+    fd, file_path = tempfile.mkstemp(suffix=f"_{base_name}.wav", dir=UPLOAD_FOLDER)
+    with os.fdopen(fd, "wb") as temp_file:
         shutil.copyfileobj(file.file, temp_file)
 
     try:
-        # Initialize the Transcriptor
-        transcriptor = Transcriptor(file_path, LOG_FOLDER, LANGUAGE, MODEL_SIZE, ACCESS_TOKEN, VOICES_FOLDER, QUANTIZATION)
-
-        # Run the diarized transcriptor
-        result = transcriptor.assemby_ai_model(AAI_API_KEY)
-
-        # Dynamically find the correct log file in the logs folder
-        base_filename = os.path.splitext(file.filename)[0]  # e.g., 'compressed'
-        matching_files = [
-            f for f in os.listdir(LOG_FOLDER)
-            if f.startswith(base_filename) and f.endswith("_en.txt")
-        ]
-
-        if not matching_files:
-            raise HTTPException(status_code=500, detail="Transcription log file not found.")
-
-        # Assuming the latest log file is the one we need
-        log_file_path = os.path.join(LOG_FOLDER, matching_files[-1])  # Pick the most recent file
-        print(f"Using log file: {log_file_path}")
-
-        # Read the transcription from the log file
-        with open(log_file_path, "r") as log_file:
-            transcription = log_file.read()
-
-        # Clean up temporary files
+        job = jobs.submit(file_path)
+    except QueueFull:
         os.remove(file_path)
+        raise HTTPException(status_code=503, detail="Too many queued transcriptions, retry later.", headers={"Retry-After": "30"})
 
-        return JSONResponse(content={"transcription": transcription}, status_code=200)
+    logger.info("queued job %s for %s", job.id, file.filename)
+    return {"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}
 
-    except Exception as e:
-        # Clean up temporary files in case of error
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """
+    status of a transcription job, with the diarized segments once it is done
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+
+    result = job.to_dict()
+    if job.segments is not None:
+        # same text as the log file, for clients of the old endpoint
+        result["transcription"] = "".join(f"{speaker} ({start} : {end}) : {text}\n" for start, end, text, speaker, *_ in job.segments if text)
+    return result
+
+@app.get("/jobs/{job_id}/events")
+def job_events(job_id: str):
+    """
+    server-sent events of a transcription job: one "segment" event per transcribed segment as soon as it is ready,
+    then a "done" or "failed" event
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+
+    def events():
+        for start, end, text, speaker in job.iter_segments():
+            yield f"event: segment\ndata: {json.dumps({'start': start, 'end': end, 'text': text, 'speaker': speaker})}\n\n"
+        yield f"event: {job.status}\ndata: {json.dumps({'job_id': job.id, 'error': job.error, 'outputs': job.outputs})}\n\n"
+
+    # the generator blocks between segments, starlette runs it in its thread pool
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/jobs")
+def jobs_stats():
+    stats = jobs.stats()
+    if RESULT_CACHE:
+        stats["result_cache"] = result_cache_stats(RESULT_CACHE)
+    return stats
@@ -2,3 +2,38 @@ from .speechlib import(
     Transcriptor,
     PreProcessor
 )
+from .model_registry import(
+    ModelRegistry,
+    set_memory_budget,
+    model_registry_stats
+)
+from .metrics import(
+    add_hook,
+    remove_hook,
+    metrics_snapshot,
+    reset_metrics,
+    prometheus_text,
+    set_log_level,
+    JsonlExporter
+)
+from .result_cache import(
+    ResultCache,
+    result_cache_stats
+)
+from .diarization_cache import(
+    DiarizationCache
+)
+from .jobs import(
+    JobQueue,
+    QueueFull
+)
+from .writers import(
+    open_writers,
+    register_writer
+)
+from .stream import(
+    SegmentStream
+)
+from .speaker_index import(
+    SpeakerIndex
+)
@@ -0,0 +1,172 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import httpx
+
+'''
+asyncio based AssemblyAI backend.
+
+all segments of a job are uploaded and submitted first, then polled together, over one pooled
+http connection pool. at most max_in_flight requests are on the wire at any time, every request
+has its own timeout, and rate limits (429), server errors (5xx) and network errors are retried
+with exponential backoff. the wall time for N segments is therefore bounded by the concurrency
+limit instead of N round trips.
+
+base_url can point at a local stand-in server that implements the same endpoints:
+
+POST /upload                -> {"upload_url": ...}
+POST /transcript            -> {"id": ...}
+GET  /transcript/{id}       -> {"status": "queued" | "processing" | "completed" | "error", "text": ..., "error": ...}
+'''
+
+AAI_BASE_URL = os.environ.get("SPEECHLIB_AAI_BASE_URL", "https://api.assemblyai.com/v2")
+AAI_MAX_IN_FLIGHT = int(os.environ.get("SPEECHLIB_AAI_MAX_IN_FLIGHT", 16))
+
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+
+
+class AssemblyAIError(Exception):
+    pass
+
+
+class AsyncAssemblyAI:
+
+    def __init__(self, api_key, base_url=AAI_BASE_URL, max_in_flight=AAI_MAX_IN_FLIGHT, max_retries=5, backoff=0.5, max_backoff=30.0,
+                 timeout=60.0, poll_interval=1.0, job_timeout=1800.0, speech_model="nano"):
+        '''
+        api_key: AssemblyAI api key
+
+        base_url: api root, override to test against a local server
+
+        max_in_flight: maximum number of concurrent http requests
+
+        max_retries: retries per request on network errors, 429 and 5xx responses
+
+        backoff, max_backoff: first and largest retry delay in seconds (doubles on every retry)
+
+        timeout: per request timeout in seconds
+
+        poll_interval: delay between polling rounds in seconds
+
+        job_timeout: give up on transcripts that are not done after this many seconds
+        '''
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.speech_model = speech_model
+
+    def _client(self):
+        limits = httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+        return httpx.AsyncClient(base_url=self.base_url, headers={"authorization": self.api_key}, limits=limits, timeout=self.timeout)
+
+    async def _request(self, client, semaphore, method, path, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with semaphore:
+                    response = await client.request(method, path, **kwargs)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json()
+                error = AssemblyAIError(f"{method} {path} returned {response.status_code}")
+            except (httpx.TransportError, httpx.TimeoutException) as err:
+                error = err
+
+            if attempt == self.max_retries:
+                raise AssemblyAIError(f"{method} {path} failed after {self.max_retries} retries: {error}")
+
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            await asyncio.sleep(delay * (0.5 + random.random() / 2))
+
+    async def _submit(self, client, semaphore, audio, language):
+        upload = await self._request(client, semaphore, "POST", "/upload", content=audio)
+        job = await self._request(client, semaphore, "POST", "/transcript", json={
+            "audio_url": upload["upload_url"],
+            "speech_model": self.speech_model,
+            "language_code": language,
+        })
+        return job["id"]
+
+    async def _poll(self, client, semaphore, job_ids):
+        results = {}
+        pending = [job_id for job_id in job_ids if not isinstance(job_id, Exception)]
+        deadline = time.monotonic() + self.job_timeout
+
+        while pending:
+            jobs = await asyncio.gather(*[self._request(client, semaphore, "GET", f"/transcript/{job_id}") for job_id in pending], return_exceptions=True)
+
+            still_pending = []
+            for job_id, job in zip(pending, jobs):
+                if isinstance(job, Exception):
+                    results[job_id] = job
+                elif job["status"] == "completed":
+                    results[job_id] = job.get("text") or ""
+                elif job["status"] == "error":
+                    results[job_id] = AssemblyAIError(job.get("error"))
+                else:
+                    still_pending.append(job_id)
+
+            pending = still_pending
+            if pending:
+                if time.monotonic() > deadline:
+                    for job_id in pending:
+                        results[job_id] = AssemblyAIError(f"transcript {job_id} timed out")
+                    break
+                await asyncio.sleep(self.poll_interval)
+
+        return results
+
+    async def transcribe_all(self, audios, language):
+        '''
+        transcribe a list of audio files given as bytes.
+        returns one entry per audio: the transcript text or the exception that made it fail
+        '''
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._client() as client:
+            job_ids = await asyncio.gather(*[self._submit(client, semaphore, audio, language) for audio in audios], return_exceptions=True)
+            results = await self._poll(client, semaphore, job_ids)
+
+        return [job_id if isinstance(job_id, Exception) else results[job_id] for job_id in job_ids]
+
+
+def run_coroutine(coroutine):
+    '''
+    run a coroutine to completion from sync code, even if this thread already runs an event loop
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    # called from inside an event loop (e.g. a FastAPI handler), run on a helper thread
+    result = {}
+
+    def runner():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as err:
+            result["error"] = err
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def transcribe_assemblyai(audios, api_key, language, **options):
+    '''
+    sync entry point: transcribe a list of wav files given as bytes.
+    returns one entry per audio, the transcript text or the exception that made it fail
+    '''
+    client = AsyncAssemblyAI(api_key, **options)
+    return run_coroutine(client.transcribe_all(audios, language))
@@ -0,0 +1,96 @@
+import wave
+import numpy as np
+import torch, torchaudio
+from pydub import AudioSegment
+
+'''
+decode-once audio container shared by every stage of core_analysis.
+
+the file is decoded a single time into mono int16 samples. stages then ask for the
+time range they need and get a zero-copy int16 view, or a float32 NumPy array, a torch
+tensor or a pydub AudioSegment built from that view only.
+'''
+
+
+class AudioBuffer:
+
+    def __init__(self, samples, sample_rate):
+        '''
+        samples: 1-D int16 numpy array (mono)
+
+        sample_rate: sample rate of samples in Hz
+        '''
+        self.samples = np.ascontiguousarray(samples, dtype=np.int16).reshape(-1)
+        self.sample_rate = int(sample_rate)
+
+    @classmethod
+    def from_file(cls, file_name):
+        '''
+        decode a 16-bit wav file. other encodings are decoded with pydub and mixed down to mono
+        '''
+        try:
+            with wave.open(file_name, 'rb') as wav_file:
+                params = wav_file.getparams()
+                if params.sampwidth == 2:
+                    samples = np.frombuffer(wav_file.readframes(params.nframes), dtype=np.int16)
+                    if params.nchannels > 1:
+                        samples = samples.reshape(-1, params.nchannels).mean(axis=1, dtype=np.int32).astype(np.int16)
+                    return cls(samples, params.framerate)
+        except (wave.Error, EOFError):
+            # not a wav file, or a truncated header
+            pass
+
+        audio = AudioSegment.from_file(file_name).set_channels(1).set_sample_width(2)
+        return cls(np.frombuffer(audio.raw_data, dtype=np.int16), audio.frame_rate)
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def _range(self, start, end):
+        # convert a time range in seconds to sample indices
+        start = 0 if start is None else max(int(round(start * self.sample_rate)), 0)
+        end = len(self.samples) if end is None else min(int(round(end * self.sample_rate)), len(self.samples))
+        return start, max(start, end)
+
+    def view(self, start=None, end=None):
+        '''
+        zero-copy int16 view of the samples between start and end seconds
+        '''
+        start, end = self._range(start, end)
+        return self.samples[start:end]
+
+    def numpy(self, start=None, end=None, sample_rate=None):
+        '''
+        float32 samples in [-1, 1] between start and end seconds, optionally resampled
+        '''
+        audio = self.view(start, end).astype(np.float32) / 32768.0
+        if sample_rate is not None and sample_rate != self.sample_rate:
+            audio = torchaudio.functional.resample(torch.from_numpy(audio), self.sample_rate, sample_rate).numpy()
+        return audio
+
+    def torch(self, start=None, end=None, sample_rate=None):
+        '''
+        float32 tensor of shape (1, samples) between start and end seconds
+        '''
+        return torch.from_numpy(self.numpy(start, end, sample_rate)).unsqueeze(0)
+
+    def pydub(self, start=None, end=None):
+        '''
+        pydub AudioSegment of the samples between start and end seconds
+        '''
+        return AudioSegment(data=self.view(start, end).tobytes(), sample_width=2, frame_rate=self.sample_rate, channels=1)
+
+    def export(self, file_name, start=None, end=None):
+        '''
+        write the samples between start and end seconds to a 16-bit mono wav file
+        '''
+        with wave.open(file_name, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.sample_rate)
+            wav_file.writeframes(self.view(start, end).tobytes())
+        return file_name
@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import wave
+import logging
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .core_analysis import (core_analysis)
+from .writers import (open_writers)
+from .diarization import (preload_diarization)
+from .speaker_recognition import (load_verification)
+from .transcribe import (preload_asr)
+from .executor import (default_workers)
+from .metrics import (set_log_level, incr)
+
+'''
+multi-file batch transcription.
+
+files are spread over a pool of worker processes. every worker loads the diarization pipeline,
+ECAPA and the ASR model once when it starts and keeps them warm for all the files it gets, so
+the per-file cost is the analysis itself. a file that raises is reported as failed without
+stopping the batch, and a file that kills its worker (segfault, out of memory) is retried once
+on a fresh pool before it is reported as failed.
+
+    python -m speechlib.batch episodes/ --log-folder logs --model-type faster-whisper --model-size small --workers 2
+    python -m speechlib.batch manifest.txt --report results.jsonl
+
+a source is a directory (searched recursively for audio files), a manifest with one path per
+line (.txt) or one {"path": ...} object per line (.jsonl), or a single audio file. relative
+manifest paths are resolved against the manifest's folder.
+
+every worker holds its own copy of the models, so size workers by memory (GPU memory in
+particular), not only by cores.
+'''
+
+AUDIO_EXTENSIONS = [".wav", ".mp3", ".m4a", ".flac", ".ogg", ".aac", ".wma", ".webm", ".mp4"]
+
+logger = logging.getLogger(__name__)
+
+# settings of the files handled by this worker process (see _init_worker)
+_settings = None
+
+
+def _read_manifest(manifest):
+    folder = os.path.dirname(os.path.abspath(manifest))
+    paths = []
+    with open(manifest, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if manifest.endswith(".jsonl") else line
+            paths.append(path if os.path.isabs(path) else os.path.join(folder, path))
+    return paths
+
+
+def collect_files(source):
+    '''
+    list the audio files of a directory, manifest file, single audio file or list of paths
+    '''
+    if isinstance(source, (list, tuple)):
+        return list(source)
+
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            # skip hidden folders such as .speechlib_cache and .voiceprints
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for file in sorted(files):
+                if os.path.splitext(file)[1].lower() in AUDIO_EXTENSIONS:
+                    paths.append(os.path.join(root, file))
+        return paths
+
+    if os.path.splitext(source)[1].lower() in AUDIO_EXTENSIONS:
+        return [source]
+
+    return _read_manifest(source)
+
+
+def audio_seconds(path):
+    '''
+    duration of a wav file from its header, None for other formats
+    '''
+    try:
+        with wave.open(path, "rb") as wav_file:
+            return wav_file.getnframes() / wav_file.getframerate()
+    except (wave.Error, EOFError, OSError):
+        return None
+
+
+def preload_models(settings):
+    '''
+    load every model core_analysis needs for settings, so the first file does not pay for it
+    '''
+    preload_diarization(settings["ACCESS_TOKEN"], settings["diarization_model"])
+
+    if settings["voices_folder"]:
+        load_verification()
+
+    num_workers = (settings["max_workers"] or default_workers()) if settings["concurrency"] == "thread" else 1
+    preload_asr(settings["language"], settings["modelSize"], settings["model_type"], settings["quantization"],
+                settings["custom_model_path"], settings["hf_model_id"], num_workers)
+
+
+def _init_worker(settings, log_level):
+    global _settings
+    _settings = settings
+    if log_level is not None:
+        set_log_level(log_level)
+
+    try:
+        preload_models(settings)
+    except Exception as err:
+        # every file will report the error when it tries to load the model again
+        logger.warning("worker %d could not preload models: %s", os.getpid(), err)
+
+
+def transcribe_file(path, settings=None):
+    '''
+    run core_analysis on one file. never raises, errors are returned in the result:
+    {"path", "ok", "segments", "error", "seconds", "audio_seconds", "worker", "outputs"}
+    '''
+    settings = dict(settings or _settings)
+    outputs = settings.pop("outputs", None)
+    start_time = time.perf_counter()
+    result = {"path": path, "ok": False, "segments": None, "error": None, "audio_seconds": audio_seconds(path), "worker": os.getpid(), "outputs": None}
+
+    writers = None
+    try:
+        if outputs:
+            writers = open_writers(outputs, settings["log_folder"], path, settings["language"])
+            result["outputs"] = writers.paths
+        result["segments"] = core_analysis(path, writers=writers, **settings)
+        result["ok"] = True
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+        logger.debug(traceback.format_exc())
+    finally:
+        if writers is not None:
+            writers.close()
+
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+class BatchProgress:
+    '''
+    running totals and rates of a batch
+    '''
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.start_time = time.perf_counter()
+
+    def update(self, result):
+        self.done += 1
+        if not result["ok"]:
+            self.failed += 1
+        if result["audio_seconds"]:
+            self.audio_seconds += result["audio_seconds"]
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        files_per_hour = self.done / elapsed * 3600 if elapsed > 0 else 0.0
+        return {
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "elapsed_seconds": elapsed,
+            "files_per_hour": files_per_hour,
+            # hours of audio transcribed per hour of wall time
+            "realtime_factor": self.audio_seconds / elapsed if elapsed > 0 else 0.0,
+            "eta_seconds": (self.total - self.done) / files_per_hour * 3600 if files_per_hour > 0 else None,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        eta = f"{summary['eta_seconds'] / 60:.0f} min" if summary["eta_seconds"] is not None else "-"
+        return (f"{self.done}/{self.total} files ({self.failed} failed), {summary['files_per_hour']:.0f} files/h, "
+                f"{summary['realtime_factor']:.1f}x realtime, ETA {eta}")
+
+
+def _failure(path, error):
+    return {"path": path, "ok": False, "segments": None, "error": error, "seconds": 0.0, "audio_seconds": audio_seconds(path), "worker": None, "outputs": None}
+
+
+def _run_in_pool(paths, settings, workers, log_level, on_result, max_crashes=1):
+    # at most two files per worker are queued so a broken pool loses little work
+    pending = list(reversed(paths))
+    crashes = {}
+    in_flight = {}
+    executor = None
+    broken = False
+    context = multiprocessing.get_context("spawn")   # CUDA can not be used in forked workers
+
+    try:
+        while pending or in_flight:
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(settings, log_level))
+                broken = False
+
+            while pending and not broken and len(in_flight) < 2 * workers:
+                path = pending.pop()
+                in_flight[executor.submit(transcribe_file, path)] = path
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    on_result(future.result())
+                except BrokenProcessPool:
+                    # a worker died and took every in-flight file with it. we can not tell which
+                    # file did it, so every one of them is retried up to max_crashes times
+                    broken = True
+                    crashes[path] = crashes.get(path, 0) + 1
+                    if crashes[path] > max_crashes:
+                        on_result(_failure(path, "worker process died while transcribing this file"))
+                    else:
+                        pending.append(path)
+
+            if broken and not in_flight:
+                incr("batch_pool_restarts")
+                logger.warning("worker pool broke, restarting it")
+                executor.shutdown(wait=False)
+                executor = None
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def transcribe_many(paths, log_folder, language, modelSize, ACCESS_TOKEN, model_type="faster-whisper", voices_folder=None, quantization=False,
+                    custom_model_path=None, hf_model_id=None, aai_api_key=None, diarization_model=None, concurrency=None, max_workers=None,
+                    long_audio=False, window_seconds=600, overlap_seconds=30, strategy="segments", coalesce=None, result_cache=None, diarization_cache=None, vad=None, outputs=None,
+                    workers=1, progress=None, report_file=None, log_level=None):
+    '''
+    transcribe many files with warm models.
+
+    paths: list of files, a directory or a manifest (see collect_files)
+
+    workers: number of worker processes. 0 runs every file in the calling process, which also
+    keeps the models warm between files
+
+    progress: optional callback(result, BatchProgress) called after every file
+
+    report_file: optional JSON lines file that gets one result per file as soon as it is done
+
+    log_level: log level of the worker processes
+
+    outputs: output formats written next to the transcript log of every file (see writers.py)
+
+    returns one result dict per file in input order (see transcribe_file)
+    '''
+    paths = collect_files(paths)
+    settings = {
+        "voices_folder": voices_folder,
+        "log_folder": log_folder,
+        "language": language,
+        "modelSize": modelSize,
+        "ACCESS_TOKEN": ACCESS_TOKEN,
+        "model_type": model_type,
+        "quantization": quantization,
+        "custom_model_path": custom_model_path,
+        "hf_model_id": hf_model_id,
+        "aai_api_key": aai_api_key,
+        "diarization_model": diarization_model,
+        "concurrency": concurrency,
+        "max_workers": max_workers,
+        "long_audio": long_audio,
+        "window_seconds": window_seconds,
+        "overlap_seconds": overlap_seconds,
+        "strategy": strategy,
+        "coalesce": coalesce,
+        "result_cache": result_cache,
+        "diarization_cache": diarization_cache,
+        "vad": vad,
+        "outputs": outputs,
+    }
+
+    tracker = BatchProgress(len(paths))
+    results = {}
+    report = open(report_file, "a", encoding="utf-8") if report_file else None
+
+    def on_result(result):
+        results[result["path"]] = result
+        tracker.update(result)
+        incr("batch_files_done")
+        if not result["ok"]:
+            incr("batch_files_failed")
+            logger.warning("failed %s: %s", result["path"], result["error"])
+        logger.info("%s %s (%.1fs) | %s", "done" if result["ok"] else "FAILED", result["path"], result["seconds"], tracker)
+        if report is not None:
+            report.write(json.dumps(result) + "\n")
+            report.flush()
+        if progress is not None:
+            progress(result, tracker)
+
+    try:
+        if workers <= 0:
+            preload_models(settings)
+            for path in paths:
+                on_result(transcribe_file(path, settings))
+        else:
+            _run_in_pool(paths, settings, workers, log_level, on_result)
+    finally:
+        if report is not None:
+            report.close()
+
+    summary = tracker.summary()
+    logger.info("batch done: %d files, %d failed, %.0f files/h, %.1fx realtime", summary["done"], summary["failed"], summary["files_per_hour"], summary["realtime_factor"])
+    return [results[path] for path in paths]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m speechlib.batch", description="transcribe many audio files with warm models")
+    parser.add_argument("source", help="directory of audio files, manifest (.txt / .jsonl) or a single file")
+    parser.add_argument("--log-folder", default="logs")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--model-size", default="tiny")
+    parser.add_argument("--model-type", default="faster-whisper", choices=["faster-whisper", "whisper", "custom", "huggingface", "assemblyAI"])
+    parser.add_argument("--custom-model-path", default=None)
+    parser.add_argument("--hf-model-id", default=None)
+    parser.add_argument("--voices-folder", default=None)
+    parser.add_argument("--quantization", action="store_true")
+    parser.add_argument("--diarization-model", default=None, help="huggingface id or local directory of the pyannote pipeline")
+    parser.add_argument("--strategy", default="segments", choices=["segments", "whole_file"])
+    parser.add_argument("--coalesce", action="store_true", help="merge short and back-to-back turns before transcription")
+    parser.add_argument("--result-cache", default=None, help="folder of the result cache, files transcribed before are skipped")
+    parser.add_argument("--diarization-cache", default=None, help="folder of the diarization cache, reruns of a file skip diarization")
+    parser.add_argument("--vad", action="store_true", help="drop silence before diarization")
+    parser.add_argument("--outputs", nargs="*", default=None, help="extra output formats: jsonl srt vtt rttm")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, 0 runs in this process")
+    parser.add_argument("--report", default=None, help="append one JSON result per file to this file")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    set_log_level(args.log_level)
+
+    results = transcribe_many(args.source, args.log_folder, args.language, args.model_size, os.environ.get("HF_ACCESS_TOKEN"), args.model_type,
+                              args.voices_folder, args.quantization, args.custom_model_path, args.hf_model_id, os.environ.get("AAI_API_KEY"),
+                              args.diarization_model, strategy=args.strategy, coalesce=args.coalesce or None, result_cache=args.result_cache, diarization_cache=args.diarization_cache, vad=args.vad or None, outputs=args.outputs,
+                              workers=args.workers, report_file=args.report, log_level=args.log_level)
+
+    failed = [result for result in results if not result["ok"]]
+    for result in failed:
+        print(f"FAILED {result['path']}: {result['error']}")
+    print(f"{len(results) - len(failed)}/{len(results)} files transcribed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,428 @@
+'''
+stage-level benchmark of the speechlib pipeline.
+
+a synthetic multi-speaker recording (44.1 kHz stereo, so preprocessing has real resampling and
+downmix work to do) and matching enrollment samples are generated, then core_analysis runs on
+them and every stage is timed by the spans it records (see metrics.py):
+
+preprocess -> vad -> diarization -> speaker_recognition -> coalesce -> transcription -> write_log_file
+
+vad and coalesce only show up when they are enabled (--vad, --coalesce), --strategy picks the
+transcription strategy.
+
+diarization, speaker embeddings and ASR default to stub backends so the benchmark runs offline on
+CPU and measures the library's own overhead. any of them can be switched to the real model.
+
+    python -m speechlib.bench --seconds 600 --speakers 3 --output run.json
+    python -m speechlib.bench --seconds 600 --speakers 3 --compare run.json --tolerance 0.2
+    python -m speechlib.bench --seconds 600 --vad --coalesce --output run_vad.json
+
+with --compare the process exits with status 1 when a stage got slower than the baseline
+(real-time factor above baseline * (1 + tolerance)) or peak RSS grew by more than the tolerance.
+'''
+
+import os
+import sys
+import json
+import wave
+import shutil
+import argparse
+import platform
+import tempfile
+from collections import namedtuple
+import numpy as np
+import torch
+
+from .preprocess import (preprocess)
+from .core_analysis import (core_analysis)
+from .diarization import (register_diarization_engine)
+from .speaker_recognition import (set_verification)
+from .transcribe import (register_backend, SAMPLE_RATE)
+from .metrics import (reset_metrics, metrics_snapshot, add_hook, remove_hook)
+
+try:
+    import resource
+except ImportError:     # windows
+    resource = None
+
+BENCH_VERSION = 2
+STAGES = ["preprocess", "vad", "diarization", "speaker_recognition", "coalesce", "transcription", "write_log_file"]
+STUB = "bench-stub"
+
+# stage timings below this many seconds are too noisy to flag as regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+
+# <-------------------synthetic audio-------------------------->
+
+def _voice(index, length, sample_rate, rng):
+    '''
+    harmonic "voice" of speaker index: its own pitch and spectral envelope, with a syllable-rate
+    amplitude envelope and a little noise
+    '''
+    t = np.arange(length) / sample_rate
+    f0 = 95.0 + 47.0 * (index % 6) + 7.0 * (index // 6)
+    pitch = f0 * (1 + 0.03 * np.sin(2 * np.pi * 0.7 * t + index))
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+
+    signal = np.zeros(len(t))
+    for h in range(1, 9):
+        weight = (1 + 0.8 * np.sin(h * (index + 1) * 1.3)) / h
+        signal += weight * np.sin(h * phase)
+
+    syllables = 0.5 * (1 - np.cos(2 * np.pi * (3.0 + 0.5 * (index % 3)) * t + rng.uniform(0, 2 * np.pi)))
+    signal *= syllables
+    signal += 0.02 * rng.standard_normal(len(t))
+    return signal / np.abs(signal).max() * 0.6
+
+
+def _write_wav(file_name, sample_rate, channels, blocks):
+    # blocks: iterable of float arrays in [-1, 1], written as they are generated
+    with wave.open(file_name, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        for block in blocks:
+            samples = (np.clip(block, -1, 1) * 32767).astype(np.int16)
+            if channels > 1:
+                # slightly different level per channel so the downmix is not a no-op
+                samples = np.stack([samples] + [(samples * (1 - 0.1 * c)).astype(np.int16) for c in range(1, channels)], axis=1)
+            wav_file.writeframes(samples.tobytes())
+
+
+def make_conversation(file_name, seconds=300, speakers=3, sample_rate=44100, channels=2, min_turn=0.3, max_turn=8.0, seed=0):
+    '''
+    write a synthetic conversation of random turns and pauses.
+    returns the ground truth turns as [(start, end, speaker index), ...]
+    '''
+    rng = np.random.default_rng(seed)
+
+    turns = []
+    position = 0.0
+    speaker = 0
+    while position < seconds:
+        # mostly alternate, sometimes the same speaker goes on after a pause
+        if rng.random() < 0.8 and speakers > 1:
+            speaker = (speaker + int(rng.integers(1, speakers))) % speakers
+        gap = float(rng.uniform(0.0, 0.6))
+        duration = float(rng.uniform(min_turn, max_turn))
+        start = min(position + gap, seconds)
+        end = min(start + duration, seconds)
+        if end - start >= min_turn:
+            turns.append((round(start, 3), round(end, 3), speaker))
+        position = end
+
+    def blocks():
+        cursor = 0.0
+        for start, end, speaker in turns:
+            if start > cursor:
+                yield 0.005 * rng.standard_normal(int(round(start * sample_rate)) - int(round(cursor * sample_rate)))
+            yield _voice(speaker, int(round(end * sample_rate)) - int(round(start * sample_rate)), sample_rate, rng)
+            cursor = end
+        if seconds > cursor:
+            yield 0.005 * rng.standard_normal(int(round(seconds * sample_rate)) - int(round(cursor * sample_rate)))
+
+    _write_wav(file_name, sample_rate, channels, blocks())
+    return turns
+
+
+def speaker_name(index):
+    return f"speaker_{index:02d}"
+
+
+def make_voices_folder(voices_folder, speakers=3, samples=2, seconds=6.0, seed=1):
+    '''
+    write enrollment samples of every synthetic speaker: voices_folder/speaker_XX/sample_N.wav
+    '''
+    rng = np.random.default_rng(seed)
+    for index in range(speakers):
+        folder = os.path.join(voices_folder, speaker_name(index))
+        os.makedirs(folder, exist_ok=True)
+        for n in range(samples):
+            _write_wav(os.path.join(folder, f"sample_{n}.wav"), SAMPLE_RATE, 1, [_voice(index, int(seconds * SAMPLE_RATE), SAMPLE_RATE, rng)])
+
+
+# <-------------------stub backends-------------------------->
+
+Turn = namedtuple("Turn", ["start", "end"])
+
+
+class StubAnnotation:
+    '''
+    the part of pyannote's Annotation that SegmentTable.from_diarization uses
+    '''
+
+    def __init__(self, turns):
+        self.turns = turns
+
+    def itertracks(self, yield_label=False):
+        for track, (start, end, label) in enumerate(self.turns):
+            if yield_label:
+                yield Turn(start, end), track, label
+            else:
+                yield Turn(start, end), track
+
+
+class StubDiarization:
+    '''
+    diarization pipeline that returns the ground truth turns of the synthetic recording
+    '''
+
+    def __init__(self, turns):
+        self.turns = [(start, end, f"SPEAKER_{speaker:02d}") for start, end, speaker in turns]
+
+    def __call__(self, file, min_speakers=0, max_speakers=10):
+        duration = file["waveform"].shape[-1] / file["sample_rate"]
+        return StubAnnotation([turn for turn in self.turns if turn[0] < duration])
+
+
+class StubEmbedder:
+    '''
+    speaker embedding model with the interface of speechbrain's SpeakerRecognition:
+    the embedding is the mean log spectrum of the clip pooled into dim bands
+    '''
+
+    def __init__(self, dim=64, frame=512):
+        self.dim = dim
+        self.frame = frame
+
+    def load_audio(self, path):
+        return preprocess(path).torch()[0]
+
+    def encode_batch(self, wavs, wav_lens=None):
+        if wavs.dim() == 1:
+            wavs = wavs.unsqueeze(0)
+        if wav_lens is None:
+            wav_lens = torch.ones(len(wavs))
+
+        embeddings = []
+        for wav, rel_len in zip(wavs, wav_lens):
+            wav = wav[:max(int(round(float(rel_len) * wavs.shape[1])), 1)]
+            if len(wav) < self.frame:
+                wav = torch.nn.functional.pad(wav, (0, self.frame - len(wav)))
+            frames = wav[:len(wav) // self.frame * self.frame].reshape(-1, self.frame)
+            spectrum = torch.log1p(torch.fft.rfft(frames * torch.hann_window(self.frame)).abs()).mean(dim=0)
+            bands = spectrum[:self.frame // 2].reshape(self.dim, -1).mean(dim=1)
+            embeddings.append(bands - bands.mean())
+
+        return torch.stack(embeddings).unsqueeze(1)
+
+
+def stub_transcribe(audios, language, model_size):
+    # roughly two and a half "words" per second of audio
+    return [" ".join(["la"] * max(1, int(len(audio) / SAMPLE_RATE * 2.5))) for audio in audios]
+
+
+# <-------------------measurements-------------------------->
+
+def peak_rss_mb():
+    '''
+    peak resident set size of this process so far in MB (None where it is not available)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_pipeline(file_name, voices_folder, log_folder, language="en", model_size="tiny", model_type=STUB, diarization_model=STUB, ACCESS_TOKEN=None,
+                 strategy="segments", coalesce=None, vad=None):
+    '''
+    run core_analysis once and read the time of every stage from its spans.
+    returns {stage: (seconds, items)}, where items is the number of transcribed segments (1 for preprocess)
+    '''
+    seconds = {}
+
+    def record(event):
+        # only the direct stages of this run, not spans of pool threads or sub-stages
+        parts = event["name"].split("/")
+        if event["type"] == "span" and len(parts) == 2 and parts[0] == "core_analysis":
+            seconds[parts[1]] = seconds.get(parts[1], 0.0) + event["seconds"]
+
+    add_hook(record)
+    try:
+        common_segments = core_analysis(file_name, voices_folder, log_folder, language, model_size, ACCESS_TOKEN, model_type,
+                                        diarization_model=diarization_model, strategy=strategy, coalesce=coalesce, vad=vad)
+    finally:
+        remove_hook(record)
+
+    timings = {stage: (stage_seconds, 1 if stage == "preprocess" else len(common_segments)) for stage, stage_seconds in seconds.items()}
+    timings["_names"] = sorted({segment[3] for segment in common_segments})
+    return timings
+
+
+def summarize(runs, audio_seconds):
+    '''
+    reduce repeated runs to one entry per stage. the best run is reported (the least disturbed
+    by other load), the first run separately since it includes model loading
+    '''
+    stages = {}
+    for stage in STAGES:
+        times = [run[stage][0] for run in runs if stage in run]
+        if not times:
+            continue
+        best = min(times)
+        items = runs[0][stage][1]
+        stages[stage] = {
+            "seconds": best,
+            "first_seconds": times[0],
+            "rtf": best / audio_seconds,
+            "audio_seconds_per_second": audio_seconds / best if best > 0 else None,
+            "items": items,
+            "items_per_second": items / best if best > 0 else None,
+        }
+
+    total = sum(stage["seconds"] for stage in stages.values())
+    return stages, {"seconds": total, "rtf": total / audio_seconds}
+
+
+def compare(result, baseline, tolerance=0.2):
+    '''
+    list the regressions of result against baseline as human readable strings
+    '''
+    regressions = []
+    for name, stage in result["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            continue
+        if stage["rtf"] > base["rtf"] * (1 + tolerance) and stage["seconds"] - base["seconds"] > MIN_REGRESSION_SECONDS:
+            regressions.append(f"{name}: rtf {stage['rtf']:.5f} vs baseline {base['rtf']:.5f} (+{(stage['rtf'] / base['rtf'] - 1) * 100:.0f}%)")
+
+    if result.get("peak_rss_mb") and baseline.get("peak_rss_mb"):
+        if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"peak_rss_mb: {result['peak_rss_mb']:.0f} vs baseline {baseline['peak_rss_mb']:.0f}")
+
+    return regressions
+
+
+def run_benchmark(seconds=300, speakers=3, repeat=3, language="en", model_size="tiny", model_type=STUB, diarization_model=STUB, embedder=STUB,
+                  ACCESS_TOKEN=None, work_dir=None, seed=0, strategy="segments", coalesce=None, vad=None):
+    '''
+    generate the synthetic data, run the pipeline repeat times and return the report dict
+    '''
+    keep_work_dir = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="speechlib_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        file_name = os.path.join(work_dir, "conversation.wav")
+        voices_folder = os.path.join(work_dir, "voices")
+        turns = make_conversation(file_name, seconds, speakers, seed=seed)
+        make_voices_folder(voices_folder, speakers, seed=seed + 1)
+
+        if diarization_model == STUB:
+            register_diarization_engine(STUB, StubDiarization(turns), ACCESS_TOKEN)
+        if embedder == STUB:
+            set_verification(StubEmbedder(), STUB)
+        if model_type == STUB:
+            register_backend(STUB, stub_transcribe)
+
+        reset_metrics()
+        runs = []
+        for r in range(repeat):
+            runs.append(run_pipeline(file_name, voices_folder, os.path.join(work_dir, f"logs_{r}"), language, model_size, model_type, diarization_model, ACCESS_TOKEN,
+                                     strategy, coalesce, vad))
+
+        stages, total = summarize(runs, seconds)
+        names = runs[-1]["_names"]
+        identified = sorted(name for name in names if not name.startswith("SPEAKER_"))
+
+        return {
+            "version": BENCH_VERSION,
+            "config": {
+                "seconds": seconds,
+                "speakers": speakers,
+                "turns": len(turns),
+                "repeat": repeat,
+                "language": language,
+                "model_size": model_size,
+                "model_type": model_type,
+                "diarization_model": diarization_model,
+                "embedder": embedder,
+                "seed": seed,
+                "strategy": strategy,
+                "coalesce": coalesce,
+                "vad": vad,
+            },
+            "machine": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "torch": torch.__version__,
+                "cuda": torch.cuda.is_available(),
+            },
+            "audio_seconds": seconds,
+            "stages": stages,
+            "total": total,
+            "peak_rss_mb": peak_rss_mb(),
+            # summed over all repeats
+            "counters": metrics_snapshot()["counters"],
+            "speakers_identified": len(identified),
+        }
+    finally:
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def format_report(report):
+    lines = [f"audio: {report['audio_seconds']:.0f}s, {report['config']['speakers']} speakers, {report['config']['turns']} turns, best of {report['config']['repeat']}"]
+    lines.append(f"{'stage':<22}{'seconds':>10}{'first':>10}{'rtf':>10}{'x realtime':>12}{'items/s':>12}")
+    for name, stage in report["stages"].items():
+        speed = stage["audio_seconds_per_second"]
+        items = stage["items_per_second"]
+        lines.append(f"{name:<22}{stage['seconds']:>10.3f}{stage['first_seconds']:>10.3f}{stage['rtf']:>10.5f}"
+                     f"{(f'{speed:.1f}' if speed else '-'):>12}{(f'{items:.1f}' if items else '-'):>12}")
+    lines.append(f"{'total':<22}{report['total']['seconds']:>10.3f}{'':>10}{report['total']['rtf']:>10.5f}")
+    if report["peak_rss_mb"] is not None:
+        lines.append(f"peak RSS: {report['peak_rss_mb']:.0f} MB")
+    lines.append(f"speakers identified: {report['speakers_identified']}/{report['config']['speakers']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m speechlib.bench", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=300, help="length of the synthetic recording")
+    parser.add_argument("--speakers", type=int, default=3, help="number of synthetic speakers")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--model-size", default="tiny")
+    parser.add_argument("--model-type", default=STUB, help=f"{STUB}, faster-whisper, whisper, ...")
+    parser.add_argument("--diarization", default=STUB, help=f"{STUB}, or a pyannote model id / local directory")
+    parser.add_argument("--embedder", default=STUB, choices=[STUB, "ecapa"])
+    parser.add_argument("--strategy", default="segments", choices=["segments", "whole_file"])
+    parser.add_argument("--coalesce", action="store_true", help="coalesce turns before transcription")
+    parser.add_argument("--vad", action="store_true", help="drop silence before diarization")
+    parser.add_argument("--access-token", default=None, help="huggingface token for a real diarization model")
+    parser.add_argument("--work-dir", default=None, help="keep the generated audio and logs here")
+    parser.add_argument("--output", default=None, help="write the JSON report to this file")
+    parser.add_argument("--compare", default=None, help="baseline JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.seconds, args.speakers, args.repeat, args.language, args.model_size, args.model_type, args.diarization, args.embedder,
+                           args.access_token, args.work_dir, args.seed, args.strategy, args.coalesce or None, args.vad or None)
+
+    print(format_report(report))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("warning: baseline was run with a different config")
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+        print(f"no regressions against {args.compare}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
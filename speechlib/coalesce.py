@@ -0,0 +1,82 @@
+import numpy as np
+from .segment_table import (SegmentTable)
+
+'''
+pre-ASR coalescing of diarized turns.
+
+pyannote often emits many sub-second turns and back-to-back turns of the same speaker, and
+every turn costs one model call. before transcription:
+
+1. consecutive turns of the same speaker separated by less than max_gap seconds are merged
+2. turns shorter than min_duration are packed into the neighbouring turn of the same speaker
+   (ignoring the gap), or dropped when drop_short is set
+3. merged turns never grow longer than max_duration seconds
+
+the coalesced table keeps, for every merged turn, the ids of the original turns in `sources`.
+'''
+
+
+def _merge(groups, starts, ends, a, b):
+    # append group b to group a
+    groups[a].extend(groups[b])
+    starts[a] = min(starts[a], starts[b])
+    ends[a] = max(ends[a], ends[b])
+
+
+def coalesce_turns(segments, max_gap=0.5, min_duration=0.5, max_duration=30.0, drop_short=False):
+    '''
+    coalesce the rows of a SegmentTable. returns (coalesced SegmentTable, stats dict)
+    '''
+    order = np.argsort(segments.start, kind="stable")
+
+    groups = []
+    starts = []
+    ends = []
+    speakers = []
+
+    # 1. merge back-to-back turns of the same speaker
+    for i in order:
+        if (groups and speakers[-1] == segments.speaker[i]
+                and segments.start[i] - ends[-1] < max_gap
+                and max(ends[-1], segments.end[i]) - starts[-1] <= max_duration):
+            groups[-1].append(int(i))
+            ends[-1] = max(ends[-1], segments.end[i])
+            continue
+        groups.append([int(i)])
+        starts.append(segments.start[i])
+        ends.append(segments.end[i])
+        speakers.append(segments.speaker[i])
+
+    # 2. pack or drop short turns
+    keep = [True] * len(groups)
+    dropped = 0
+    for g in range(len(groups)):
+        if ends[g] - starts[g] >= min_duration:
+            continue
+        if drop_short:
+            keep[g] = False
+            dropped += len(groups[g])
+            continue
+
+        # pack into the previous or next kept group of the same speaker if it stays under max_duration
+        for n in [g - 1, g + 1]:
+            if 0 <= n < len(groups) and keep[n] and speakers[n] == speakers[g] and max(ends[n], ends[g]) - min(starts[n], starts[g]) <= max_duration:
+                _merge(groups, starts, ends, n, g)
+                keep[g] = False
+                break
+
+    kept = [g for g in range(len(groups)) if keep[g]]
+
+    table = SegmentTable([starts[g] for g in kept], [ends[g] for g in kept], [segments.tag[groups[g][0]] for g in kept], segments.tags)
+    table.names = list(segments.names)
+    table.speaker = np.asarray([speakers[g] for g in kept], dtype=np.int32)
+    table.sources = [np.asarray(sorted(groups[g]), dtype=np.int64) for g in kept]
+
+    stats = {
+        "turns": len(segments),
+        "coalesced_turns": len(table),
+        "dropped_turns": dropped,
+        "model_calls_saved": len(segments) - len(table),
+    }
+
+    return table, stats
@@ -1,5 +1,9 @@
 import wave
+import logging
 import numpy as np
+from .preprocess import (downmix)
+
+logger = logging.getLogger(__name__)
 
 def convert_to_mono(input_wav):
     # Open the input WAV file
@@ -14,7 +18,7 @@ def convert_to_mono(input_wav):
             audio_data = np.frombuffer(frames, dtype=np.int16)
 
             # Take the average of the channels to convert to mono
-            mono_audio_data = np.mean(audio_data.reshape(-1, params.nchannels), axis=1)
+            mono_audio_data = downmix(audio_data, params.nchannels)
 
             # Create a new WAV file for mono audio
             with wave.open(input_wav, 'wb') as output_file:
@@ -22,10 +26,10 @@ def convert_to_mono(input_wav):
                 output_file.setparams((1, params.sampwidth, params.framerate, len(mono_audio_data), params.comptype, params.compname))
 
                 # Write the mono audio data to the output file
-                output_file.writeframes(np.int16(mono_audio_data))
+                output_file.writeframes(mono_audio_data.tobytes())
 
-            print(f'{input_wav} converted to mono')
+            logger.info('%s converted to mono', input_wav)
         else:
-            print(f'{input_wav} is already a mono audio file.')
+            logger.info('%s is already a mono audio file.', input_wav)
 
 
@@ -1,11 +1,14 @@
 from pydub import AudioSegment
 import os
+import logging
+
+logger = logging.getLogger(__name__)
 
 def convert_to_wav(input_file):
     # Load the MP3 file using pydub
     # Check if the file is already in WAV format
     if input_file.lower().endswith(".wav"):
-        print(f"{input_file} is already in WAV format.")
+        logger.info("%s is already in WAV format.", input_file)
         return input_file
     
     audio = AudioSegment.from_file(input_file)
@@ -16,7 +19,7 @@ def convert_to_wav(input_file):
     # Export the audio to WAV
     audio.export(wav_path, format="wav")
 
-    print(f"{input_file} has been converted to WAV format.")
+    logger.info("%s has been converted to WAV format.", input_file)
 
     return wav_path
 
@@ -1,153 +1,202 @@
-import os
-from pyannote.audio import Pipeline
-import time
+import logging
 from .wav_segmenter import (wav_file_segmentation)
-import torch, torchaudio
+from .diarization import (get_diarization_engine, diarization_source)
 
-from .speaker_recognition import (speaker_recognition)
+from .speaker_recognition import (recognize_speakers, embedding_model_name)
+from .voiceprint_store import (voices_fingerprint)
+from .result_cache import (get_result_cache, audio_hash)
+from .diarization_cache import (get_diarization_cache)
 from .write_log_file import (write_log_file)
 
-from .re_encode import (re_encode)
-from .convert_to_mono import (convert_to_mono)
-from .convert_to_wav import (convert_to_wav)
+from .preprocess import (preprocess)
+from .segment_table import (SegmentTable)
+from .long_audio import (long_audio_analysis)
+from .word_alignment import (transcribe_words, align_words_to_segments)
+from .coalesce import (coalesce_turns)
+from .vad import (apply_vad)
+from .writers import (OrderedEmitter)
+from .metrics import (span, incr)
+
+logger = logging.getLogger(__name__)
 
 # by default use google speech-to-text API
 # if False, then use whisper finetuned version for sinhala
-def core_analysis(file_name, voices_folder, log_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization=False, custom_model_path=None, hf_model_id=None, aai_api_key=None):
+#
+# strategy "segments" transcribes every diarized turn as its own clip.
+# strategy "whole_file" transcribes the whole file once with word timestamps and
+# assigns every word to the turn it overlaps most (faster-whisper, whisper and custom only)
+#
+# coalesce: True or a dict of coalesce_turns options (max_gap, min_duration, max_duration, drop_short)
+# merges short and back-to-back turns of the same speaker before transcription
+#
+# long_audio: windowed processing (see long_audio.py). only strategy "segments" without coalesce is supported
+#
+# result_cache: True, a folder or a ResultCache. results are stored under a hash of the decoded audio
+# and the settings, and a later call with the same audio and settings returns them without any model
+# (not used with long_audio)
+#
+# diarization_cache: True, a folder or a DiarizationCache. diarization turns are stored under a hash of the
+# decoded audio and the pipeline version, so reruns with another model or voices folder skip pyannote
+#
+# vad: True or a dict of vad.energy_vad options (threshold_db, margin_db, min_speech, min_silence, padding).
+# silence is cut out before diarization (and whole_file transcription) and all times are mapped back to the
+# original recording (not used with long_audio)
+#
+# writers: a writers.SegmentWriters (see open_writers). every transcribed segment is appended to its files in
+# time order as soon as it and all earlier segments are done. writers.paths["log"] is set to the transcript log
+def core_analysis(file_name, voices_folder, log_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization=False, custom_model_path=None, hf_model_id=None, aai_api_key=None, diarization_model=None, concurrency=None, max_workers=None, long_audio=False, window_seconds=600, overlap_seconds=30, strategy="segments", coalesce=None, result_cache=None, diarization_cache=None, vad=None, writers=None):
+
+    # multi-hour recordings are processed window by window with bounded memory
+    if long_audio:
+        if strategy != "segments" or coalesce:
+            raise ValueError("long_audio only supports strategy 'segments' without coalesce")
+        return long_audio_analysis(file_name, voices_folder, log_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization, custom_model_path, hf_model_id, aai_api_key, diarization_model, concurrency, max_workers,
+                                   window_seconds, overlap_seconds, writers)
+
+    with span("core_analysis"):
+        return _core_analysis(file_name, voices_folder, log_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization, custom_model_path, hf_model_id, aai_api_key, diarization_model, concurrency, max_workers, strategy, coalesce, result_cache, diarization_cache, vad, writers)
+
+def _core_analysis(file_name, voices_folder, log_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization, custom_model_path, hf_model_id, aai_api_key, diarization_model, concurrency, max_workers, strategy, coalesce, result_cache, diarization_cache, vad, writers):
 
     # <-------------------PreProcessing file-------------------------->
 
-    # check if file is in wav format, if not convert to wav
-    file_name = convert_to_wav(file_name)
-
-    # convert file to mono
-    convert_to_mono(file_name)
-
-    # re-encode file to 16-bit PCM encoding
-    re_encode(file_name)
+    # decode, convert to 16-bit, downmix to mono and resample to 16 kHz in one pass.
+    # the input file is left untouched and every stage below slices this buffer
+    with span("preprocess"):
+        audio = preprocess(file_name)
+
+    # hash of the decoded audio, shared by the caches
+    audio_digest = None
+    if result_cache or diarization_cache:
+        with span("audio_hash"):
+            audio_digest = audio_hash(audio)
+
+    # <--------------------result cache--------------------------->
+
+    cache = None
+    if result_cache:
+        cache = get_result_cache(result_cache)
+        settings = {
+            "language": language,
+            "model_type": model_type,
+            "modelSize": modelSize,
+            "quantization": quantization,
+            "custom_model_path": custom_model_path,
+            "hf_model_id": hf_model_id,
+            "strategy": strategy,
+            "coalesce": coalesce,
+            "vad": vad,
+            "diarization_model": diarization_source(diarization_model),
+            "embedding_model": embedding_model_name() if voices_folder else None,
+            "voices": voices_fingerprint(voices_folder) if voices_folder else None,
+        }
+        with span("result_cache"):
+            cache_key = cache.key(audio_digest, settings)
+            common_segments = cache.get(cache_key)
+
+        if common_segments is not None:
+            logger.info("result cache hit for %s", file_name)
+            if writers is not None:
+                writers.write_segments(common_segments)
+            with span("write_log_file"):
+                log_file = write_log_file(common_segments, log_folder, file_name, language, audio)
+            if writers is not None:
+                writers.paths["log"] = log_file
+            return common_segments
 
     # <--------------------running analysis--------------------------->
 
-    speaker_tags = []
-    
-    start_time = int(time.time())
-    pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization@2.1",
-                                    use_auth_token=ACCESS_TOKEN)
-    end_time = int(time.time())
-    elapsed_time = int(end_time - start_time)
-    print(f"pipeline loaded. Time taken: {elapsed_time} seconds.")
-
-    if torch.cuda.is_available():
-        device = torch.device("cuda")
-    elif torch.backends.mps.is_available():
-        device = torch.device("mps")
-        os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
-    else:
-        device = torch.device("cpu")
-
-    pipeline.to(device)
-    waveform, sample_rate = torchaudio.load(file_name)
-
-    start_time = int(time.time())
-    print("running diarization...")
-    diarization = pipeline({"waveform": waveform, "sample_rate": sample_rate}, min_speakers=0, max_speakers=10)
-    end_time = int(time.time())
-    elapsed_time = int(end_time - start_time)
-    print(f"diarization done. Time taken: {elapsed_time} seconds.")
-
-    speakers = {}
-
-    common = []
+    # <--------------------silence removal--------------------------->
+
+    # diarization (and whole_file ASR) run on the speech only, their times are mapped back with timemap.
+    # recognition, segment ASR and the log file slice the original audio with original times
+    speech_audio = audio
+    timemap = None
+    if vad:
+        options = vad if isinstance(vad, dict) else {}
+        with span("vad"):
+            speech_audio, timemap, vad_stats = apply_vad(audio, **options)
+        incr("vad_seconds_skipped", vad_stats["skipped_seconds"])
+        logger.info("vad kept %.1fs of speech in %d regions, skipped %.1fs of %.1fs", vad_stats["speech_seconds"], vad_stats["regions"], vad_stats["skipped_seconds"], vad_stats["duration"])
+
+    # the pipeline is loaded on first use and shared by every later call in this process
+    pipeline = get_diarization_engine(ACCESS_TOKEN, diarization_model)
+
+    diarization = None
+    if diarization_cache:
+        diarization_store = get_diarization_cache(diarization_cache)
+        diarization_key = diarization_store.key(audio_digest, diarization_source(diarization_model), 0, 10, variant=f"vad:{vad}" if vad else None)
+        diarization = diarization_store.get(diarization_key)
+        if diarization is not None:
+            logger.info("diarization cache hit for %s", file_name)
+
+    logger.info("running diarization...")
+    with span("diarization"):
+        if diarization is None:
+            diarization = pipeline(speech_audio, min_speakers=0, max_speakers=10)
+            if diarization_cache:
+                diarization_store.put(diarization_key, diarization)
+
+        # one row per diarized turn, with a stable id used to join transcripts back
+        if timemap is None:
+            segments = SegmentTable.from_diarization(diarization)
+        else:
+            segments = SegmentTable.from_diarization(diarization, decimals=3)
+            segments.to_original_time(timemap)
+    incr("segments_diarized", len(segments))
+    logger.info("diarization done. %d segments", len(segments))
 
     # create a dictionary of SPEAKER_XX to real name mappings
-    speaker_map = {}
-
-    for turn, _, speaker in diarization.itertracks(yield_label=True):
-
-        start = round(turn.start, 1)
-        end = round(turn.end, 1)
-        common.append([start, end, speaker])
-
-        # find different speakers
-        if speaker not in speaker_tags:
-            speaker_tags.append(speaker)
-            speaker_map[speaker] = speaker
-            speakers[speaker] = []
-
-        speakers[speaker].append([start, end, speaker])
+    speaker_map = {tag: tag for tag in segments.tags}
 
     if voices_folder != None and voices_folder != "":
-        identified = []
-
-        start_time = int(time.time())
-        print("running speaker recognition...")
-        print("voices folder: ", voices_folder)
-        for spk_tag, spk_segments in speakers.items():
-            start_time_segment = int(time.time())
-            spk_name = speaker_recognition(file_name, voices_folder, spk_segments, identified)
-            end_time_segment = int(time.time())
-            elapsed_time_segment = int(end_time_segment - start_time_segment)
-            print(f"speaker {spk_tag} recognition done. Time taken: {elapsed_time_segment} seconds.")
-            spk = spk_name
-            identified.append(spk)
-            speaker_map[spk_tag] = spk
-        end_time = int(time.time())
-        elapsed_time = int(end_time - start_time)
-        print(f"speaker recognition done. Time taken: {elapsed_time} seconds.")
-
-    keys_to_remove = []
-    merged = []
-
-    # merging same speakers
-    for spk_tag1, spk_segments1 in speakers.items():
-        for spk_tag2, spk_segments2 in speakers.items():
-            if spk_tag1 not in merged and spk_tag2 not in merged and spk_tag1 != spk_tag2 and speaker_map[spk_tag1] == speaker_map[spk_tag2]:
-                for segment in spk_segments2:
-                    speakers[spk_tag1].append(segment)
-
-                merged.append(spk_tag1)
-                merged.append(spk_tag2)
-                keys_to_remove.append(spk_tag2)
-    
-    # fixing the speaker names in common
-    for segment in common:
-        speaker = segment[2]
-        segment[2] = speaker_map[speaker]
-
-    for key in keys_to_remove:
-        del speakers[key]
-        del speaker_map[key]
-    
-
-    # transcribing the texts differently according to speaker
-    start_time = int(time.time())
-    print("running transcription...")
-    for spk_tag, spk_segments in speakers.items():
-        spk = speaker_map[spk_tag]
-        segment_out = wav_file_segmentation(file_name, spk_segments, language, modelSize, model_type, quantization, custom_model_path, hf_model_id, aai_api_key)
-        speakers[spk_tag] = segment_out
-    end_time = int(time.time())
-    elapsed_time = int(end_time - start_time)
-    print(f"transcription done. Time taken: {elapsed_time} seconds.")
-
-    common_segments = []
-
-    for item in common:
-        speaker = item[2]
-        start = item[0]
-        end = item[1]
-
-        for spk_tag, spk_segments in speakers.items():
-            if speaker == speaker_map[spk_tag]:
-                for segment in spk_segments:
-                    if start == segment[0] and end == segment[1]:
-                        # if speaker is not unknown
-                        if speaker != 'unknown':
-                            common_segments.append([start, end, segment[2], speaker])
-                        else:
-                            common_segments.append([start, end, segment[2], spk_tag])
+        # one centroid per diarized speaker, assigned to the enrollees all at once
+        logger.info("running speaker recognition. voices folder: %s", voices_folder)
+        with span("speaker_recognition"):
+            segments_by_tag = {spk_tag: segments.rows(spk_ids) for spk_tag, spk_ids in segments.ids_by_tag().items()}
+            speaker_map.update(recognize_speakers(voices_folder, segments_by_tag, audio))
+        logger.info("speaker recognition done. %s", speaker_map)
+
+    # merging same speakers and fixing the speaker names.
+    # unknown speakers keep their own SPEAKER_XX tag
+    segments.relabel(speaker_map)
+
+    if coalesce:
+        options = coalesce if isinstance(coalesce, dict) else {}
+        with span("coalesce"):
+            segments, stats = coalesce_turns(segments, **options)
+        incr("model_calls_saved", stats["model_calls_saved"])
+        logger.info("coalesced %d turns into %d (%d dropped). model calls saved: %d", stats["turns"], stats["coalesced_turns"], stats["dropped_turns"], stats["model_calls_saved"])
+
+    logger.info("running transcription...")
+    with span("transcription", strategy=strategy):
+        if strategy == "whole_file":
+            # one decode over the whole file, words are grouped back into the diarized turns
+            word_starts, word_ends, words = transcribe_words(speech_audio, language, modelSize, model_type, quantization, custom_model_path)
+            if timemap is not None:
+                word_starts, word_ends = timemap.to_original(word_starts), timemap.to_original(word_ends, end=True)
+            align_words_to_segments(segments, word_starts, word_ends, words)
+            if writers is not None:
+                writers.write_segments(segments.to_list())
+        elif strategy == "segments":
+            # transcribing the segments of all speakers in one pass so they can run concurrently
+            on_segments = OrderedEmitter(segments, writers.write) if writers is not None else None
+            wav_file_segmentation(file_name, segments, language, modelSize, model_type, quantization, custom_model_path, hf_model_id, aai_api_key, audio=audio, concurrency=concurrency, max_workers=max_workers, on_segments=on_segments)
+        else:
+            raise Exception(f"strategy {strategy} is not supported. use 'segments' or 'whole_file'")
+    logger.info("transcription done")
 
     # writing log file
-    write_log_file(common_segments, log_folder, file_name, language)  
+    with span("write_log_file"):
+        log_file = write_log_file(segments, log_folder, file_name, language, audio)
+    if writers is not None:
+        writers.paths["log"] = log_file
+
+    common_segments = segments.to_list()
+
+    # a segment without text failed to transcribe (except for whole_file, where a turn can have no words),
+    # such results are not cached so a retry runs the models again
+    if cache is not None and (strategy == "whole_file" or all(text is not None for text in segments.text)):
+        cache.put(cache_key, common_segments)
 
     return common_segments
@@ -0,0 +1,149 @@
+import os
+import time
+import threading
+import logging
+import torch
+from pyannote.audio import Pipeline
+from .executor import (worker_replica)
+from .metrics import (span, incr)
+
+'''
+long-lived pyannote diarization pipeline.
+
+the pipeline is loaded once per (source, token, worker replica) and reused by every
+core_analysis call in the process. a pipeline is not thread-safe, so calls on one engine are
+serialized; every worker replica (e.g. every JobQueue worker, see executor.worker_replica) gets
+its own engine so workers diarize in parallel. source can be a huggingface model id or a local directory containing the
+pipeline config.yaml (with the segmentation/embedding entries pointing at local checkpoints),
+which allows loading without network access.
+'''
+
+DIARIZATION_MODEL = "pyannote/speaker-diarization@2.1"
+
+logger = logging.getLogger(__name__)
+
+
+def get_device():
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    elif torch.backends.mps.is_available():
+        os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
+        return torch.device("mps")
+    else:
+        return torch.device("cpu")
+
+
+class DiarizationEngine:
+
+    def __init__(self, source=DIARIZATION_MODEL, ACCESS_TOKEN=None, device=None, pipeline=None):
+        '''
+        source: huggingface model id, local directory with config.yaml, or path to a config.yaml
+
+        ACCESS_TOKEN: huggingface access token (not needed for local sources)
+
+        device: torch device, picked automatically if not given
+
+        pipeline: already built pipeline to use instead of loading source (e.g. a stub for benchmarks).
+        any callable taking {"waveform", "sample_rate"} and returning an object with itertracks() works
+        '''
+        self.source = source
+        self.ACCESS_TOKEN = ACCESS_TOKEN
+        self.device = device
+        self.pipeline = pipeline
+        self._load_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.pipeline is not None
+
+    def load(self):
+        '''
+        load the pipeline if it is not loaded yet. safe to call from several threads
+        '''
+        if self.pipeline is not None:
+            return self
+
+        with self._load_lock:
+            if self.pipeline is None:
+                source = self.source
+                if os.path.isdir(source):
+                    source = os.path.join(source, "config.yaml")
+
+                start_time = time.perf_counter()
+                with span("load_model", backend="pyannote", model=self.source):
+                    pipeline = Pipeline.from_pretrained(source, use_auth_token=self.ACCESS_TOKEN)
+                    if pipeline is None:
+                        raise Exception(f"could not load diarization pipeline from {self.source}. check the access token or the local path")
+
+                    if self.device is None:
+                        self.device = get_device()
+                    pipeline.to(self.device)
+                self.pipeline = pipeline
+                incr("model_loads")
+
+                elapsed_time = time.perf_counter() - start_time
+                logger.info("pipeline loaded. Time taken: %.2f seconds.", elapsed_time)
+
+        return self
+
+    def __call__(self, audio, min_speakers=0, max_speakers=10):
+        '''
+        diarize an AudioBuffer. calls on this engine are serialized since the pipeline is not thread-safe
+        '''
+        self.load()
+        with self._run_lock:
+            return self.pipeline({"waveform": audio.torch(), "sample_rate": audio.sample_rate}, min_speakers=min_speakers, max_speakers=max_speakers)
+
+
+_engines = {}               # (source, token, replica) -> engine
+_registered = {}            # (source, token) -> engine around a prebuilt pipeline, shared by every replica
+_engines_lock = threading.Lock()
+
+
+def diarization_source(source=None):
+    '''
+    the pipeline used for source: source itself, SPEECHLIB_DIARIZATION_MODEL or the default model
+    '''
+    return source or os.environ.get("SPEECHLIB_DIARIZATION_MODEL", DIARIZATION_MODEL)
+
+
+def get_diarization_engine(ACCESS_TOKEN=None, source=None, replica=None):
+    '''
+    return the engine for source (default: pyannote/speaker-diarization@2.1) of the worker replica
+    (default: the calling thread's, see executor.worker_replica)
+    '''
+    source = diarization_source(source)
+    if replica is None:
+        replica = worker_replica()
+    with _engines_lock:
+        engine = _registered.get((source, ACCESS_TOKEN))
+        if engine is None:
+            key = (source, ACCESS_TOKEN, replica)
+            engine = _engines.get(key)
+            if engine is None:
+                engine = _engines[key] = DiarizationEngine(source, ACCESS_TOKEN)
+    return engine
+
+
+def register_diarization_engine(source, pipeline, ACCESS_TOKEN=None):
+    '''
+    make get_diarization_engine(ACCESS_TOKEN, source) return an engine around an already built pipeline.
+    the engine is shared by every worker replica, so its calls are serialized
+    '''
+    engine = DiarizationEngine(source, ACCESS_TOKEN, pipeline=pipeline)
+    with _engines_lock:
+        _registered[(source, ACCESS_TOKEN)] = engine
+    return engine
+
+
+def preload_diarization(ACCESS_TOKEN=None, source=None, replicas=None):
+    '''
+    load the diarization pipeline ahead of the first request (e.g. at service startup)
+
+    replicas: worker replicas to load a pipeline for (default: the calling thread's).
+    returns the engine, or the list of engines of the replicas
+    '''
+    if replicas is None:
+        return get_diarization_engine(ACCESS_TOKEN, source).load()
+    return [get_diarization_engine(ACCESS_TOKEN, source, replica).load() for replica in replicas]
@@ -0,0 +1,146 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+from .metrics import (incr)
+
+'''
+on-disk cache of diarization results.
+
+diarization costs the same no matter which ASR backend or voices folder is used, so its output is
+stored per (decoded audio hash, pipeline, pipeline version, speaker bounds). a rerun of the same
+file with another model_type, modelSize or an updated voices folder loads the turns from disk and
+only runs speaker recognition and transcription again.
+
+entries are compact .npz files (start and end times as float64, label codes and labels), so the
+turns come back bit-identical and the downstream stages see exactly what pyannote returned.
+'''
+
+logger = logging.getLogger(__name__)
+
+DIARIZATION_CACHE_DIR = os.environ.get("SPEECHLIB_DIARIZATION_CACHE_DIR", os.path.join(".speechlib_cache", "diarization"))
+
+Turn = namedtuple("Turn", ["start", "end"])
+
+
+class CachedDiarization:
+    '''
+    diarization turns loaded from the cache. has the itertracks() of pyannote's Annotation
+    that SegmentTable.from_diarization uses
+    '''
+
+    def __init__(self, start, end, labels):
+        self.start = start
+        self.end = end
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.start)
+
+    def itertracks(self, yield_label=False):
+        for track, (start, end, label) in enumerate(zip(self.start, self.end, self.labels)):
+            if yield_label:
+                yield Turn(float(start), float(end)), track, label
+            else:
+                yield Turn(float(start), float(end)), track
+
+
+def pipeline_version(source):
+    '''
+    identifies the pipeline behind source: the pyannote.audio version, plus the content of the
+    config.yaml for local pipelines so edits to it invalidate cached results
+    '''
+    try:
+        import pyannote.audio
+        version = pyannote.audio.__version__
+    except (ImportError, AttributeError):
+        version = "unknown"
+
+    config = os.path.join(source, "config.yaml") if os.path.isdir(source) else source
+    if os.path.isfile(config):
+        with open(config, "rb") as f:
+            version += ":" + hashlib.sha1(f.read()).hexdigest()
+    return version
+
+
+class DiarizationCache:
+
+    def __init__(self, cache_dir=DIARIZATION_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, audio_digest, source, min_speakers=0, max_speakers=10, variant=None):
+        '''
+        cache key of the audio (its audio_hash) diarized by the pipeline from source.
+        variant tells apart diarizations of transformed audio (e.g. with silence removed)
+        '''
+        if source not in self._versions:
+            self._versions[source] = pipeline_version(source)
+        return hashlib.sha1(f"{audio_digest}:{source}:{self._versions[source]}:{min_speakers}:{max_speakers}:{variant}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def get(self, key):
+        '''
+        cached diarization for key, or None
+        '''
+        try:
+            with np.load(self._path(key)) as data:
+                labels = data["labels"]
+                diarization = CachedDiarization(data["start"], data["end"], [str(labels[code]) for code in data["codes"]])
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            incr("diarization_cache_misses")
+            return None
+
+        self.hits += 1
+        incr("diarization_cache_hits")
+        return diarization
+
+    def put(self, key, diarization):
+        start = []
+        end = []
+        codes = []
+        labels = {}
+        for turn, _, label in diarization.itertracks(yield_label=True):
+            start.append(turn.start)
+            end.append(turn.end)
+            codes.append(labels.setdefault(label, len(labels)))
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, start=np.asarray(start, dtype=np.float64), end=np.asarray(end, dtype=np.float64),
+                 codes=np.asarray(codes, dtype=np.int32), labels=np.asarray(list(labels), dtype=str))
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_diarization_cache(cache=True):
+    '''
+    resolve the diarization_cache argument of core_analysis: True for the default cache, a folder
+    path, or a DiarizationCache instance
+    '''
+    if isinstance(cache, DiarizationCache):
+        return cache
+
+    cache_dir = DIARIZATION_CACHE_DIR if cache is True else cache
+    key = os.path.abspath(cache_dir)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DiarizationCache(cache_dir)
+        return _caches[key]
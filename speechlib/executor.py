@@ -0,0 +1,111 @@
+import os
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+'''
+bounded worker pools used to transcribe segments concurrently.
+
+concurrency modes:
+
+none: run everything in the calling thread
+
+thread: thread pool. faster-whisper (CTranslate2) releases the GIL, so one shared model loaded
+with num_workers=max_workers scales with cores. torch based backends get one model per worker
+thread (see worker_replica), and remote backends like assemblyAI simply overlap their requests.
+
+process: process pool. every worker process keeps its own model registry, so models are loaded
+once per worker and stay warm for later calls. workers are spawned, not forked, because CUDA
+can not be used in a process forked after the parent initialized it.
+
+every worker holds its own model replica, so the default number of workers is small
+(SPEECHLIB_MAX_WORKERS, 4) rather than one per core.
+
+pools are cached per (mode, max_workers) so worker threads/processes and their models are reused.
+'''
+
+CONCURRENCY_MODES = ["none", "thread", "process"]
+
+# default pool size. every worker loads its own model replica, so this bounds memory rather than cores
+MAX_WORKERS = int(os.environ.get("SPEECHLIB_MAX_WORKERS", 4))
+
+_local = threading.local()
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _init_worker(counter):
+    _local.replica = next(counter)
+
+
+def worker_replica():
+    '''
+    index of the current pool worker thread (0 outside of a thread pool)
+    '''
+    return getattr(_local, "replica", 0)
+
+
+def set_worker_replica(replica):
+    '''
+    mark the current thread as worker replica (for long-lived threads that are not part of a pool here)
+    '''
+    _local.replica = replica
+
+
+def default_workers():
+    '''
+    MAX_WORKERS, but no more than the number of cores. every worker thread or process loads its own
+    model replica, so the default stays small on large machines; pass max_workers to go higher
+    '''
+    return max(1, min(MAX_WORKERS, os.cpu_count() or 1))
+
+
+def get_executor(concurrency, max_workers=None):
+    '''
+    return a cached executor for the concurrency mode, or None for "none"
+    '''
+    if concurrency in [None, "none"]:
+        return None
+    if concurrency not in CONCURRENCY_MODES:
+        raise Exception(f"concurrency {concurrency} is not supported. use one of {CONCURRENCY_MODES}")
+
+    max_workers = max_workers or default_workers()
+    key = (concurrency, max_workers)
+
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            if concurrency == "thread":
+                executor = ThreadPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(itertools.count(),))
+            else:
+                # CUDA can not be used in forked workers
+                executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+            _executors[key] = executor
+
+    return executor
+
+
+def iter_ordered(fn, items, concurrency=None, max_workers=None):
+    '''
+    apply fn to every item, possibly concurrently. results are yielded in the order of items,
+    each one as soon as it and all earlier ones are done
+    '''
+    executor = get_executor(concurrency, max_workers)
+    if executor is None:
+        return (fn(item) for item in items)
+    return executor.map(fn, items)
+
+
+def map_ordered(fn, items, concurrency=None, max_workers=None):
+    '''
+    apply fn to every item, possibly concurrently. results keep the order of items
+    '''
+    return list(iter_ordered(fn, items, concurrency, max_workers))
+
+
+def shutdown_executors():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
@@ -0,0 +1,221 @@
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+from .executor import (set_worker_replica)
+from .metrics import (incr)
+
+'''
+in-process job queue for serving transcriptions.
+
+submit() puts a job on a bounded queue and returns immediately with its id. a fixed set of
+worker threads takes jobs off the queue and runs them with the models that are already warm in
+this process (model registry, diarization engine, ECAPA), so a slow transcription never blocks
+the caller and throughput grows with the number of workers. when the queue is full submit()
+raises QueueFull so the service can answer 503 instead of piling up work.
+
+every worker thread is its own model replica for backends that are not thread-safe
+(see executor.worker_replica). finished jobs are kept for lookups up to max_finished jobs.
+
+run_job can report segments while the job runs with job.add_segment(), readers follow them
+with job.iter_segments() (used for server-sent events).
+'''
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _segment_dict(segment):
+    start, end, text, speaker = segment[:4]
+    record = {"start": start, "end": end, "text": text, "speaker": speaker}
+    # coalesced segments carry the ids of the diarized turns they were merged from
+    if len(segment) > 4:
+        record["source_ids"] = segment[4]
+    return record
+
+
+class Job:
+
+    def __init__(self, file_path, options=None):
+        self.id = uuid.uuid4().hex
+        self.file_path = file_path
+        self.options = options or {}
+        self.status = QUEUED
+        self.segments = None
+        # segments reported while the job runs, see add_segment
+        self.partial = []
+        self.error = None
+        # output files of the job, filled by run_job (see Transcriptor.output_paths)
+        self.outputs = {}
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self._changed = threading.Condition()
+
+    def add_segment(self, segment):
+        '''
+        report a finished (start, end, text, speaker) segment of a running job
+        '''
+        with self._changed:
+            self.partial.append(segment)
+            self._changed.notify_all()
+
+    def set_done(self):
+        with self._changed:
+            self.done.set()
+            self._changed.notify_all()
+
+    def iter_segments(self):
+        '''
+        yield the reported segments, the ones reported later as soon as they arrive, until the job is finished
+        '''
+        i = 0
+        while True:
+            with self._changed:
+                while i >= len(self.partial) and not self.done.is_set():
+                    self._changed.wait()
+                segments = self.partial[i:]
+                finished = self.done.is_set()
+
+            yield from segments
+            i += len(segments)
+            if finished and i >= len(self.partial):
+                return
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "outputs": self.outputs,
+            "segments": None if self.segments is None else [_segment_dict(segment) for segment in self.segments],
+        }
+
+
+class JobQueue:
+
+    def __init__(self, run_job, workers=2, max_queued=16, max_finished=1000, cleanup=True):
+        '''
+        run_job: function taking a Job and returning its [[start, end, text, speaker], ...] segments
+
+        workers: number of worker threads
+
+        max_queued: jobs waiting beyond this are rejected with QueueFull
+
+        max_finished: finished jobs kept for get(), oldest are dropped first
+
+        cleanup: delete the job's file when it is finished
+        '''
+        self.run_job = run_job
+        self.workers = workers
+        self.max_finished = max_finished
+        self.cleanup = cleanup
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @property
+    def replicas(self):
+        '''
+        worker replicas of the job workers, e.g. to preload their models (see diarization.preload_diarization)
+        '''
+        return [("job", index) for index in range(self.workers)]
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(i,), name=f"speechlib-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def shutdown(self, wait=True):
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    @property
+    def full(self):
+        return self._queue.full()
+
+    def stats(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return {"workers": self.workers, "max_queued": self._queue.maxsize, **counts}
+
+    def submit(self, file_path, **options):
+        '''
+        queue a job for file_path. raises QueueFull when max_queued jobs are already waiting
+        '''
+        job = Job(file_path, options)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            incr("jobs_rejected")
+            raise QueueFull(f"{self._queue.maxsize} jobs are already queued")
+
+        incr("jobs_submitted")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _finish(self, job):
+        job.finished = time.time()
+        job.set_done()
+        if self.cleanup and job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+
+        with self._lock:
+            finished = [job_id for job_id, other in self._jobs.items() if other.status in [DONE, FAILED]]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[job_id]
+
+    def _work(self, index):
+        # keep torch models of this worker apart from pool threads used inside a job
+        set_worker_replica(self.replicas[index])
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            job.status = RUNNING
+            job.started = time.time()
+            try:
+                job.segments = self.run_job(job)
+                job.status = DONE
+                incr("jobs_done")
+            except Exception as err:
+                job.error = f"{type(err).__name__}: {err}"
+                job.status = FAILED
+                incr("jobs_failed")
+                logger.exception("job %s failed", job.id)
+            finally:
+                self._finish(job)
@@ -0,0 +1,200 @@
+import os
+import logging
+from datetime import datetime
+import numpy as np
+from .audio_buffer import (AudioBuffer)
+from .preprocess import (iter_preprocessed, TARGET_SAMPLE_RATE)
+from .diarization import (get_diarization_engine)
+from .segment_table import (SegmentTable)
+from .speaker_recognition import (embed_segments, get_store, THRESHOLD)
+from .wav_segmenter import (transcribe_segments)
+from .metrics import (span, incr)
+
+'''
+windowed processing of multi-hour recordings.
+
+the file is streamed through the preprocessor and cut into fixed windows that overlap by
+overlap_seconds. every window is diarized on its own, its local speakers are linked to the
+speakers of earlier windows by ECAPA embedding similarity, and its turns are transcribed and
+written out before the next window is read. only one window is held in memory at a time, so
+peak memory does not grow with the length of the recording.
+
+a turn belongs to the window that contains its midpoint in the window's core region
+(the window minus half the overlap on each inner side), so turns in overlaps are not duplicated.
+'''
+
+logger = logging.getLogger(__name__)
+
+# cosine similarity needed to link a window speaker to an existing speaker
+LINK_THRESHOLD = 0.5
+
+
+def iter_windows(file_name, window_seconds=600, overlap_seconds=30, sample_rate=TARGET_SAMPLE_RATE):
+    '''
+    yield (offset in seconds, AudioBuffer, is_last) windows of the preprocessed file
+    '''
+    window = int(window_seconds * sample_rate)
+    hop = window - int(overlap_seconds * sample_rate)
+    if hop <= 0:
+        raise Exception("overlap_seconds must be smaller than window_seconds")
+
+    buffer = np.empty(window, dtype=np.int16)
+    size = 0
+    offset = 0
+
+    for chunk in iter_preprocessed(file_name, sample_rate):
+        while len(chunk):
+            take = min(window - size, len(chunk))
+            buffer[size:size + take] = chunk[:take]
+            size += take
+            chunk = chunk[take:]
+
+            if size == window:
+                yield offset / sample_rate, AudioBuffer(buffer.copy(), sample_rate), False
+                # keep the overlap as the start of the next window
+                buffer[:window - hop] = buffer[hop:]
+                size = window - hop
+                offset += hop
+
+    yield offset / sample_rate, AudioBuffer(buffer[:size].copy(), sample_rate), True
+
+
+class SpeakerLinker:
+    '''
+    keeps one running centroid embedding per global speaker and maps window speakers onto them
+    '''
+
+    def __init__(self, threshold=LINK_THRESHOLD, store=None):
+        self.threshold = threshold
+        self.store = store
+        self.centroids = []     # unnormalized sums of normalized embeddings
+        self.labels = []
+
+    def _new_label(self, embedding):
+        label = f"SPEAKER_{len(self.labels):02d}"
+        if self.store is not None and self.store.speakers:
+            # identify new speakers against the enrollees that are not taken yet
+            scores = self.store.score(embedding)[0]
+            scores = np.where([name not in self.labels for name in self.store.speakers], scores, -np.inf)
+            if scores.max() > THRESHOLD:
+                label = self.store.speakers[int(np.argmax(scores))]
+        return label
+
+    def link(self, embeddings):
+        '''
+        embeddings: {window tag: embedding}, ordered by importance (e.g. speech duration).
+        returns {window tag: global label}. two tags of one window never share a global label
+        '''
+        mapping = {}
+        taken = set()
+
+        for tag, embedding in embeddings.items():
+            embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+
+            best = -1
+            best_score = self.threshold
+            for i, centroid in enumerate(self.centroids):
+                if i in taken:
+                    continue
+                score = float(centroid @ embedding) / max(np.linalg.norm(centroid), 1e-12)
+                if score >= best_score:
+                    best = i
+                    best_score = score
+
+            if best < 0:
+                best = len(self.centroids)
+                self.labels.append(self._new_label(embedding))
+                self.centroids.append(np.zeros_like(embedding))
+
+            self.centroids[best] = self.centroids[best] + embedding
+            taken.add(best)
+            mapping[tag] = self.labels[best]
+
+        return mapping
+
+
+def _speaker_embeddings(audio, segments, max_turns=5, min_duration=0.5):
+    # one embedding per window speaker from its longest turns, longest speakers first
+    embeddings = {}
+    speech = {}
+    for tag, ids in segments.ids_by_tag().items():
+        ids = ids[np.argsort(-segments.duration[ids], kind="stable")]
+        long_ids = ids[segments.duration[ids] >= min_duration][:max_turns]
+        speech[tag] = segments.duration[ids].sum()
+        embeddings[tag] = embed_segments(audio, segments.rows(long_ids if len(long_ids) else ids[:1])).mean(axis=0)
+
+    return {tag: embeddings[tag] for tag in sorted(embeddings, key=speech.get, reverse=True)}
+
+
+def iter_long_audio(file_name, voices_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization=False, custom_model_path=None, hf_model_id=None, aai_api_key=None, diarization_model=None, concurrency=None, max_workers=None,
+                    window_seconds=600, overlap_seconds=30, link_threshold=LINK_THRESHOLD):
+    '''
+    yield [[start, end, text, speaker], ...] for every window as soon as it is transcribed
+    '''
+    pipeline = get_diarization_engine(ACCESS_TOKEN, diarization_model)
+
+    store = None
+    if voices_folder != None and voices_folder != "":
+        store = get_store(voices_folder)
+
+    linker = SpeakerLinker(link_threshold, store)
+
+    for offset, audio, is_last in iter_windows(file_name, window_seconds, overlap_seconds):
+        # the span is closed before yielding, consumers of the generator are not timed
+        with span("long_audio_window", offset=offset):
+            with span("diarization"):
+                diarization = pipeline(audio, min_speakers=0, max_speakers=10)
+                segments = SegmentTable.from_diarization(diarization, decimals=3)
+            incr("segments_diarized", len(segments))
+            if not len(segments):
+                continue
+
+            # keep the turns whose midpoint lies in this window's core region
+            core_start = 0 if offset == 0 else overlap_seconds / 2
+            core_end = audio.duration if is_last else window_seconds - overlap_seconds / 2
+            middle = (segments.start + segments.end) / 2
+            keep = np.flatnonzero((middle >= core_start) & (middle < core_end))
+
+            with span("speaker_linking"):
+                segments.relabel(linker.link(_speaker_embeddings(audio, segments)))
+
+            with span("transcription"):
+                trans = transcribe_segments(audio, segments.rows(keep), language, modelSize, model_type, quantization, custom_model_path, hf_model_id, aai_api_key, concurrency=concurrency, max_workers=max_workers)
+
+            window_segments = []
+            for i, text in zip(keep, trans):
+                if text is not None:
+                    window_segments.append([round(float(offset + segments.start[i]), 1), round(float(offset + segments.end[i]), 1), text, segments.speaker_of(i)])
+
+        logger.info("window at %.0fs done (%d segments)", offset, len(window_segments))
+
+        yield window_segments
+
+
+def long_audio_analysis(file_name, voices_folder, log_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization=False, custom_model_path=None, hf_model_id=None, aai_api_key=None, diarization_model=None, concurrency=None, max_workers=None,
+                        window_seconds=600, overlap_seconds=30, writers=None):
+    '''
+    windowed version of core_analysis. the transcript log (and writers) are appended and flushed after every window
+    '''
+    os.makedirs(log_folder, exist_ok=True)
+    current_time = datetime.now().strftime('%H%M%S')
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    log_file = os.path.join(log_folder, f"{base_name}_{current_time}_{language}.txt")
+    if writers is not None:
+        writers.paths["log"] = log_file
+
+    common_segments = []
+    with open(log_file, "wb") as lf:
+        for window_segments in iter_long_audio(file_name, voices_folder, language, modelSize, ACCESS_TOKEN, model_type, quantization, custom_model_path, hf_model_id, aai_api_key, diarization_model, concurrency, max_workers,
+                                               window_seconds, overlap_seconds):
+            entry = ""
+            for start, end, text, speaker, *_ in window_segments:
+                if text:
+                    entry += f"{speaker} ({start} : {end}) : {text}\n"
+            lf.write(entry.encode('utf-8'))
+            lf.flush()
+            if writers is not None:
+                writers.write_segments(window_segments)
+            common_segments.extend(window_segments)
+
+    return common_segments
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+'''
+instrumentation shared by every stage of the library.
+
+- spans: time.perf_counter timings of stages and sub-stages. spans nest per thread, so a span
+  opened inside "core_analysis" is recorded as "core_analysis/diarization"
+- counters: model loads, segments, embeddings, errors ...
+- hooks: callables that receive every finished span and counter update as an event dict
+- exporters: JSON lines (a hook that appends one event per line) and Prometheus text format
+
+    from speechlib import add_hook, prometheus_text, JsonlExporter
+
+    add_hook(lambda event: print(event))
+    add_hook(JsonlExporter("speechlib_events.jsonl"))
+    ...
+    print(prometheus_text())
+
+messages go through the "speechlib" logger. per-segment messages are DEBUG, stage summaries INFO,
+so production logs stay quiet at the default WARNING level. SPEECHLIB_LOG_LEVEL or set_log_level()
+change the level. spans and counters of process pool workers stay in the worker processes.
+'''
+
+logger = logging.getLogger("speechlib")
+
+
+def set_log_level(level):
+    '''
+    set the level of the "speechlib" logger ("DEBUG", "INFO", logging.WARNING, ...).
+    adds a stderr handler if neither the library logger nor the root logger has one
+    '''
+    if isinstance(level, str):
+        level = level.upper()
+    logger.setLevel(level)
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+
+
+if os.environ.get("SPEECHLIB_LOG_LEVEL"):
+    set_log_level(os.environ["SPEECHLIB_LOG_LEVEL"])
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            # {span name: [count, total seconds, max seconds]}
+            self.spans = {}
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _emit(self, event):
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception as err:
+                logger.warning("metrics hook %r failed: %s", hook, err)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        '''
+        time the block under name. attrs are passed on to the hooks
+        '''
+        stack = self._stack()
+        path = "/".join(stack + [name])
+        stack.append(name)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            stack.pop()
+            with self._lock:
+                entry = self.spans.setdefault(path, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+            logger.debug("%s took %.3f seconds", path, seconds)
+            if self.hooks:
+                self._emit({"type": "span", "name": path, "seconds": seconds, "time": time.time(), **attrs})
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.hooks:
+            self._emit({"type": "counter", "name": name, "value": value, "time": time.time()})
+
+    def snapshot(self):
+        '''
+        {"counters": {name: value}, "spans": {name: {"count", "total_seconds", "max_seconds"}}}
+        '''
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "spans": {name: {"count": count, "total_seconds": total, "max_seconds": longest} for name, (count, total, longest) in self.spans.items()},
+            }
+
+    def prometheus(self, prefix="speechlib"):
+        '''
+        counters and span summaries in the Prometheus text exposition format
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+
+        if snapshot["spans"]:
+            metric = f"{prefix}_stage_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for name, span in sorted(snapshot["spans"].items()):
+                lines.append(f'{metric}_sum{{stage="{name}"}} {span["total_seconds"]:.6f}')
+                lines.append(f'{metric}_count{{stage="{name}"}} {span["count"]}')
+            lines.append(f"# TYPE {prefix}_stage_seconds_max gauge")
+            for name, span in sorted(snapshot["spans"].items()):
+                lines.append(f'{prefix}_stage_seconds_max{{stage="{name}"}} {span["max_seconds"]:.6f}')
+
+        return "\n".join(lines) + "\n"
+
+
+class JsonlExporter:
+    '''
+    hook that appends every event to a JSON lines file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# process-wide instance used by the library
+metrics = Metrics()
+
+
+def span(name, **attrs):
+    return metrics.span(name, **attrs)
+
+
+def incr(name, value=1):
+    metrics.incr(name, value)
+
+
+def add_hook(hook):
+    '''
+    call hook(event) for every finished span and counter update. events are dicts with
+    "type" ("span" or "counter"), "name", "time" and "seconds" or "value"
+    '''
+    metrics.hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    if hook in metrics.hooks:
+        metrics.hooks.remove(hook)
+
+
+def metrics_snapshot():
+    return metrics.snapshot()
+
+
+def reset_metrics():
+    metrics.reset()
+
+
+def prometheus_text():
+    return metrics.prometheus()
@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from .metrics import (span, incr)
+
+'''
+process-wide registry of warm ASR models.
+
+models are keyed by (backend, model size or path, device, compute type, replica) and handed
+out on every call instead of being rebuilt per diarized segment. when the estimated
+memory of the loaded models exceeds the budget, the least recently used ones are evicted.
+
+replica lets concurrent workers hold their own instance of a backend that is not
+thread-safe (see executor.worker_replica).
+
+the budget can be set with the SPEECHLIB_MODEL_CACHE_MB environment variable or with
+set_memory_budget(). a budget of 0 disables the limit.
+'''
+
+logger = logging.getLogger(__name__)
+
+# approximate in-memory size (MB) of whisper checkpoints, used when the model object
+# cannot report its own parameter size (faster-whisper / CTranslate2 models)
+_WHISPER_SIZES_MB = {
+    "tiny": 75,
+    "base": 145,
+    "small": 485,
+    "medium": 1530,
+    "large": 3090,
+    "large-v1": 3090,
+    "large-v2": 3090,
+    "large-v3": 3090,
+}
+
+
+def _estimate_size(model, model_name):
+    '''
+    estimate the memory used by a loaded model in bytes
+    '''
+    # huggingface pipelines keep the torch module in .model
+    module = getattr(model, "model", model)
+    parameters = getattr(module, "parameters", None)
+
+    if callable(parameters):
+        try:
+            return sum(p.numel() * p.element_size() for p in parameters())
+        except Exception:
+            pass
+
+    name = os.path.basename(str(model_name)).split(".")[0]
+    return _WHISPER_SIZES_MB.get(name, 0) * 1024 * 1024
+
+
+class ModelRegistry:
+
+    def __init__(self, memory_budget_mb=None):
+        if memory_budget_mb is None:
+            memory_budget_mb = float(os.environ.get("SPEECHLIB_MODEL_CACHE_MB", 0))
+
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self._models = OrderedDict()    # key -> (model, size in bytes)
+        self._lock = threading.RLock()
+        self._key_locks = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, backend, model_name, device, compute_type, loader, replica=0):
+        '''
+        return a warm model for the key, calling loader() to build it on a miss
+        '''
+        key = (backend, str(model_name), str(device), str(compute_type), replica)
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key][0]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # load outside the registry lock so other keys stay available,
+        # but make sure concurrent callers of the same key load it only once
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    self.hits += 1
+                    return self._models[key][0]
+
+            try:
+                start_time = time.perf_counter()
+                with span("load_model", backend=backend, model=str(model_name)):
+                    model = loader()
+                elapsed_time = time.perf_counter() - start_time
+                incr("model_loads")
+
+                with self._lock:
+                    self.misses += 1
+                    self.load_time += elapsed_time
+                    self._models[key] = (model, _estimate_size(model, model_name))
+                    self._evict(keep=key)
+            finally:
+                # the lock is only needed while the key loads. callers that already hold it find the
+                # model above, later callers take the fast path, so locks do not pile up per replica
+                with self._lock:
+                    if self._key_locks.get(key) is key_lock:
+                        del self._key_locks[key]
+
+        return model
+
+    def _evict(self, keep):
+        # drop least recently used models until we are back under the budget.
+        # the model that was just requested is never evicted.
+        if self.memory_budget <= 0:
+            return
+
+        while self.memory_usage() > self.memory_budget and len(self._models) > 1:
+            key = next(iter(self._models))
+            if key == keep:
+                self._models.move_to_end(key)
+                key = next(iter(self._models))
+            del self._models[key]
+            self.evictions += 1
+            incr("model_evictions")
+            logger.info("evicted model %s to stay under %d MB", key, self.memory_budget)
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def set_memory_budget(self, memory_budget_mb):
+        with self._lock:
+            self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+            if self._models:
+                self._evict(keep=next(reversed(self._models)))
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_time": self.load_time,
+                "models": len(self._models),
+                "memory_usage": self.memory_usage(),
+                "memory_budget": self.memory_budget,
+            }
+
+
+# shared registry used by transcribe() and whisper_sinhala()
+registry = ModelRegistry()
+
+
+def get_model(backend, model_name, device, compute_type, loader, replica=0):
+    return registry.get(backend, model_name, device, compute_type, loader, replica)
+
+
+def set_memory_budget(memory_budget_mb):
+    registry.set_memory_budget(memory_budget_mb)
+
+
+def model_registry_stats():
+    return registry.stats()
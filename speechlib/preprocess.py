@@ -0,0 +1,277 @@
+import os
+import wave
+import hashlib
+import logging
+import subprocess
+from collections import namedtuple
+import numpy as np
+from pydub import AudioSegment
+from .audio_buffer import (AudioBuffer)
+
+'''
+single pass, chunked preprocessing of an input file into 16 kHz mono 16-bit PCM.
+
+the input is read in fixed size chunks and every chunk goes through the same vectorized
+steps: sample width conversion to int16, downmix to mono and resampling. memory use is
+bounded by the chunk size (plus the output buffer when the result is kept in memory).
+inputs that are not wav are decoded by an ffmpeg process and read from its pipe in the same
+fixed size chunks, so compressed formats are never held in memory as a whole either.
+the input file is never modified.
+'''
+
+logger = logging.getLogger(__name__)
+
+TARGET_SAMPLE_RATE = 16000
+CHUNK_FRAMES = 1 << 16
+
+AudioParams = namedtuple("AudioParams", ["nchannels", "sampwidth", "framerate", "nframes"])
+
+
+def to_int16(data, sampwidth):
+    '''
+    convert raw little-endian PCM bytes of 8, 16, 24 or 32 bit samples to int16
+    '''
+    if sampwidth == 1:
+        # 8-bit wav is unsigned
+        return ((np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128) << 8).astype(np.int16)
+    elif sampwidth == 2:
+        return np.frombuffer(data, dtype=np.int16)
+    elif sampwidth == 3:
+        # keep the two most significant bytes of every 24-bit sample
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        return np.ascontiguousarray(raw[:, 1:]).view('<i2').reshape(-1)
+    elif sampwidth == 4:
+        return (np.frombuffer(data, dtype='<i4') >> 16).astype(np.int16)
+    else:
+        raise Exception(f"Unsupported sample width: {sampwidth}")
+
+
+def downmix(samples, nchannels):
+    '''
+    average interleaved int16 channels into mono without going through float64
+    '''
+    if nchannels == 1:
+        return samples
+    return (samples.reshape(-1, nchannels).sum(axis=1, dtype=np.int32) // nchannels).astype(np.int16)
+
+
+def _lowpass(cutoff, taps):
+    # windowed sinc low-pass filter, cutoff in cycles per sample
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
+
+
+def output_length(n_in, in_rate, out_rate):
+    '''
+    number of samples n_in samples at in_rate are resampled to: ceil(n_in * out_rate / in_rate)
+    '''
+    return -(-n_in * out_rate // in_rate)
+
+
+class Resampler:
+    '''
+    streaming resampler: anti-alias low-pass filter followed by linear interpolation.
+    state is carried between chunks so the output does not depend on the chunk size.
+    '''
+
+    def __init__(self, in_rate, out_rate, taps=101):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.step = in_rate / out_rate
+        self.taps = taps
+        self.filter = _lowpass(0.475 / self.step, taps) if in_rate > out_rate else None
+        self.history = np.zeros(taps - 1 if self.filter is not None else 0, dtype=np.float32)
+        self.delay = (taps - 1) // 2 if self.filter is not None else 0
+
+        self.buffer = np.zeros(0, dtype=np.float32)    # filtered samples not consumed yet
+        self.base = 0                                   # stream index of buffer[0]
+        self.position = float(self.delay)               # stream position of the next output sample
+        self.consumed = 0                               # input samples seen so far
+        self.produced = 0                               # output samples emitted so far
+
+    def process(self, samples, final=False):
+        '''
+        resample the next chunk of float32 samples. pass final=True with the last chunk
+        '''
+        samples = np.asarray(samples, dtype=np.float32)
+        self.consumed += len(samples)
+
+        if final and self.delay:
+            # flush the filter delay line
+            samples = np.concatenate([samples, np.zeros(self.delay, dtype=np.float32)])
+
+        if self.filter is not None:
+            padded = np.concatenate([self.history, samples])
+            filtered = np.convolve(padded, self.filter, mode="valid").astype(np.float32)
+            self.history = padded[len(padded) - len(self.history):]
+        else:
+            filtered = samples
+
+        buffer = np.concatenate([self.buffer, filtered])
+        last = self.base + len(buffer) - 1
+
+        count = int(np.floor((last - self.position) / self.step)) + 1 if last >= self.position else 0
+        if final:
+            # emit exactly ceil(n_in * out_rate / in_rate) samples in total. when upsampling the
+            # last positions lie past the last input sample and take its value
+            count = output_length(self.consumed, self.in_rate, self.out_rate) - self.produced
+        count = max(count, 0)
+
+        positions = self.position + self.step * np.arange(count)
+        out = np.interp(positions - self.base, np.arange(len(buffer)), buffer).astype(np.float32)
+
+        self.position += count * self.step
+        self.produced += count
+
+        keep_from = min(max(int(np.floor(self.position)) - self.base, 0), len(buffer))
+        self.buffer = buffer[keep_from:]
+        self.base += keep_from
+
+        return out
+
+
+def _float_to_int16(samples):
+    return np.clip(np.round(samples), -32768, 32767).astype(np.int16)
+
+
+def _iter_wav_chunks(wav_file, params, chunk_frames):
+    # read the wav file chunk by chunk and yield mono int16 chunks
+    with wav_file:
+        while True:
+            data = wav_file.readframes(chunk_frames)
+            if not data:
+                break
+            yield downmix(to_int16(data, params.sampwidth), params.nchannels)
+
+
+def _iter_ffmpeg_chunks(file_name, sample_rate, chunk_frames):
+    # decode with ffmpeg (the binary pydub is configured with) into mono int16 at sample_rate
+    command = [AudioSegment.converter, "-nostdin", "-v", "error", "-i", file_name,
+               "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate), "-"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(2 * chunk_frames)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16)
+        error = process.stderr.read().decode("utf-8", "replace").strip()
+        if process.wait() != 0:
+            raise Exception(f"ffmpeg could not decode {file_name}: {error}")
+    finally:
+        # the consumer may stop early, do not leave ffmpeg running
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def open_chunks(file_name, chunk_frames=CHUNK_FRAMES, sample_rate=TARGET_SAMPLE_RATE):
+    '''
+    open file_name for chunked reading. returns (AudioParams, iterator of mono int16 chunks)
+
+    sample_rate: rate non-wav inputs are decoded to by ffmpeg. their length is not known up
+    front, so nframes is 0
+    '''
+    try:
+        wav_file = wave.open(file_name, 'rb')
+    except (wave.Error, EOFError):
+        params = AudioParams(1, 2, sample_rate, 0)
+        return params, _iter_ffmpeg_chunks(file_name, sample_rate, chunk_frames)
+
+    wav_params = wav_file.getparams()
+    params = AudioParams(wav_params.nchannels, wav_params.sampwidth, wav_params.framerate, wav_params.nframes)
+    return params, _iter_wav_chunks(wav_file, params, chunk_frames)
+
+
+def resample_chunks(chunks, in_rate, sample_rate=TARGET_SAMPLE_RATE):
+    '''
+    resample an iterator of mono int16 chunks from in_rate to sample_rate
+    '''
+    if in_rate == sample_rate:
+        yield from chunks
+        return
+
+    resampler = Resampler(in_rate, sample_rate)
+    pending = None
+    for chunk in chunks:
+        # hold back one chunk so the last one can be flagged as final
+        if pending is not None:
+            yield _float_to_int16(resampler.process(pending))
+        pending = chunk.astype(np.float32)
+
+    yield _float_to_int16(resampler.process(pending if pending is not None else np.zeros(0), final=True))
+
+
+def iter_preprocessed(file_name, sample_rate=TARGET_SAMPLE_RATE, chunk_frames=CHUNK_FRAMES):
+    '''
+    yield mono int16 chunks of file_name resampled to sample_rate
+    '''
+    params, chunks = open_chunks(file_name, chunk_frames, sample_rate)
+    return resample_chunks(chunks, params.framerate, sample_rate)
+
+
+def is_preprocessed(file_name, sample_rate=TARGET_SAMPLE_RATE):
+    '''
+    check whether file_name is already a mono 16-bit wav at sample_rate
+    '''
+    try:
+        with wave.open(file_name, 'rb') as wav_file:
+            params = wav_file.getparams()
+        return params.nchannels == 1 and params.sampwidth == 2 and params.framerate == sample_rate
+    except (wave.Error, EOFError):
+        return False
+
+
+def preprocess(file_name, sample_rate=TARGET_SAMPLE_RATE, chunk_frames=CHUNK_FRAMES):
+    '''
+    preprocess file_name into an in-memory AudioBuffer (mono, 16-bit, sample_rate)
+    '''
+    if is_preprocessed(file_name, sample_rate):
+        return AudioBuffer.from_file(file_name)
+
+    params, chunks = open_chunks(file_name, chunk_frames, sample_rate)
+    # preallocate the output so chunks are not concatenated at the end
+    expected = output_length(params.nframes, params.framerate, sample_rate)
+    samples = np.empty(expected, dtype=np.int16)
+
+    size = 0
+    for chunk in resample_chunks(chunks, params.framerate, sample_rate):
+        if size + len(chunk) > len(samples):
+            samples = np.resize(samples, max(2 * len(samples), size + len(chunk)))
+        samples[size:size + len(chunk)] = chunk
+        size += len(chunk)
+
+    return AudioBuffer(samples[:size], sample_rate)
+
+
+def preprocess_to_file(file_name, output_folder=".speechlib_cache", sample_rate=TARGET_SAMPLE_RATE, chunk_frames=CHUNK_FRAMES):
+    '''
+    preprocess file_name into a cached wav file and return its path.
+    the cache entry is keyed by the input path, size and mtime, so it is reused across runs.
+    '''
+    if is_preprocessed(file_name, sample_rate):
+        return file_name
+
+    stat = os.stat(file_name)
+    key = hashlib.sha1(f"{os.path.abspath(file_name)}:{stat.st_size}:{stat.st_mtime}:{sample_rate}".encode()).hexdigest()[:16]
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    output_file = os.path.join(output_folder, f"{base_name}_{key}_{sample_rate // 1000}k.wav")
+
+    if os.path.exists(output_file):
+        return output_file
+
+    os.makedirs(output_folder, exist_ok=True)
+    tmp_file = output_file + ".tmp"
+    with wave.open(tmp_file, 'wb') as new_file:
+        new_file.setnchannels(1)
+        new_file.setsampwidth(2)
+        new_file.setframerate(sample_rate)
+        for chunk in iter_preprocessed(file_name, sample_rate, chunk_frames):
+            new_file.writeframes(chunk.tobytes())
+    os.replace(tmp_file, output_file)
+
+    logger.info("%s preprocessed. Saved as %s", file_name, output_file)
+    return output_file
@@ -1,7 +1,10 @@
 import wave
-import struct
+import logging
+from .preprocess import (to_int16)
 
-def re_encode(file_name):
+logger = logging.getLogger(__name__)
+
+def re_encode(file_name, chunk_frames=1 << 16):
 
     with wave.open(file_name, 'rb') as original_file:
 
@@ -11,9 +14,9 @@ def re_encode(file_name):
         # Check if the sample width is already 16-bit
         if params.sampwidth == 2:
 
-            print("The file already has 16-bit samples.")
+            logger.info("The file already has 16-bit samples.")
 
-        elif params.sampwidth == 1:
+        elif params.sampwidth in [1, 3, 4]:
             
             # Open a new WAV file with 16-bit samples
             file_name = file_name + '_16bit.wav'
@@ -22,16 +25,14 @@ def re_encode(file_name):
                 # Set the new audio parameters
                 new_file.setparams(params)
                 new_file.setsampwidth(2)
-                new_file.setnchannels(1)
 
-                # Read and convert each sample
-                for _ in range(params.nframes):
-                    sample = original_file.readframes(1)
-                    sample_value = struct.unpack("<B", sample)[0]
-                    new_sample_value = (sample_value - 128) * 256
-                    new_sample = struct.pack("<h", new_sample_value)
-                    new_file.writeframes(new_sample)
+                # convert the samples chunk by chunk
+                while True:
+                    frames = original_file.readframes(chunk_frames)
+                    if not frames:
+                        break
+                    new_file.writeframes(to_int16(frames, params.sampwidth).tobytes())
 
-            print("Conversion completed. Saved as " + file_name)
+            logger.info("Conversion completed. Saved as %s", file_name)
         else:
-            print("Unsupported sample width.")
\ No newline at end of file
+            logger.warning("Unsupported sample width.")
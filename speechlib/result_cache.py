@@ -0,0 +1,198 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from .metrics import (incr)
+
+'''
+content-addressed cache of finished transcriptions.
+
+the key is a hash of the decoded audio (16 kHz mono samples, so re-uploads and re-encodes of the
+same recording hit) and of every setting that changes the result: language, model type and size,
+quantization, custom/huggingface model, strategy, coalescing, diarization and embedding model and
+a fingerprint of the voices folder. a hit returns the stored common_segments without running
+diarization, recognition or ASR.
+
+entries are small json files under cache_dir/<key[:2]>/<key>.json. the file mtime is the last
+use, so the LRU order survives restarts; when the total size grows over max_bytes the least
+recently used entries are deleted.
+'''
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_DIR = os.environ.get("SPEECHLIB_RESULT_CACHE_DIR", os.path.join(".speechlib_cache", "results"))
+RESULT_CACHE_MB = float(os.environ.get("SPEECHLIB_RESULT_CACHE_MB", 512))
+
+# bump when the format of cached results changes
+CACHE_VERSION = 2
+
+
+def audio_hash(audio):
+    '''
+    sha1 of the decoded samples and sample rate of an AudioBuffer
+    '''
+    sha1 = hashlib.sha1(f"{audio.sample_rate}:".encode())
+    sha1.update(memoryview(audio.samples).cast("B"))
+    return sha1.hexdigest()
+
+
+def settings_hash(settings):
+    '''
+    sha1 of a dict of settings, independent of key order
+    '''
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, max_mb=RESULT_CACHE_MB):
+        '''
+        cache_dir: folder of the cache entries
+
+        max_mb: size budget in MB, least recently used entries are evicted beyond it (0 = no limit)
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> size in bytes, least recently used first
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._scan()
+
+    def _scan(self):
+        # rebuild the LRU order from the entry files on disk
+        entries = []
+        if os.path.isdir(self.cache_dir):
+            for root, _, files in os.walk(self.cache_dir):
+                for file in files:
+                    if file.endswith(".json"):
+                        stat = os.stat(os.path.join(root, file))
+                        entries.append((stat.st_mtime, file[:-len(".json")], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def key(self, audio_digest, settings):
+        '''
+        cache key of the audio (its audio_hash) transcribed with settings
+        '''
+        return hashlib.sha1(f"{CACHE_VERSION}:{audio_digest}:{settings_hash(settings)}".encode()).hexdigest()
+
+    def get(self, key):
+        '''
+        stored common_segments for key, or None
+        '''
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                segments = json.load(f)["segments"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+                if key in self._entries:
+                    self.size -= self._entries.pop(key)
+            incr("result_cache_misses")
+            return None
+
+        # mark as recently used, on disk too
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        incr("result_cache_hits")
+        return segments
+
+    def put(self, key, segments):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "segments": segments}, f)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self.size -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self.size += size
+            self._evict(keep=key)
+
+    def _evict(self, keep):
+        if self.max_bytes <= 0:
+            return
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            key, size = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self.size -= size
+            self.evictions += 1
+            incr("result_cache_evictions")
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_mb": self.size / (1024 * 1024),
+                "max_mb": self.max_bytes / (1024 * 1024),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_result_cache(cache=True):
+    '''
+    resolve the result_cache argument of core_analysis: True for the default cache, a folder
+    path, or a ResultCache instance. caches are shared per folder within the process
+    '''
+    if isinstance(cache, ResultCache):
+        return cache
+
+    cache_dir = RESULT_CACHE_DIR if cache is True else cache
+    key = os.path.abspath(cache_dir)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ResultCache(cache_dir)
+        return _caches[key]
+
+
+def result_cache_stats(cache=True):
+    return get_result_cache(cache).stats()
@@ -0,0 +1,152 @@
+import numpy as np
+
+'''
+columnar table of diarized segments shared by core_analysis, wav_file_segmentation and write_log_file.
+
+every row has a stable id (its position in diarization order), start/end times, the diarization
+tag (SPEAKER_XX) and the recognized speaker name, both stored as int codes into label lists, and
+the transcript. relabeling speakers is a single lookup-table gather over the code array, and
+transcripts are joined back by row id instead of by matching rounded start/end times.
+'''
+
+
+class SegmentTable:
+
+    def __init__(self, start, end, tag, tags):
+        '''
+        start, end: segment times in seconds
+
+        tag: int code of the diarization label of every segment
+
+        tags: diarization labels, indexed by code
+        '''
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+        self.tag = np.asarray(tag, dtype=np.int32)
+        self.tags = list(tags)
+        self.id = np.arange(len(self.start), dtype=np.int64)
+
+        # recognized speaker names, identical to the diarization tags until relabel()
+        self.speaker = self.tag.copy()
+        self.names = list(self.tags)
+
+        self.text = [None] * len(self.start)
+
+        # ids of the original turns behind every row when the table was coalesced
+        self.sources = None
+
+    @classmethod
+    def from_diarization(cls, diarization, decimals=1):
+        '''
+        build the table from a pyannote Annotation, times rounded to decimals
+        '''
+        start = []
+        end = []
+        tag = []
+        codes = {}
+        for turn, _, speaker in diarization.itertracks(yield_label=True):
+            start.append(round(turn.start, decimals))
+            end.append(round(turn.end, decimals))
+            tag.append(codes.setdefault(speaker, len(codes)))
+        return cls(start, end, tag, list(codes))
+
+    @classmethod
+    def from_list(cls, segments):
+        '''
+        build the table from [[start, end, text, speaker], ...] (the common_segments format).
+        the source_ids of coalesced segments are kept in sources
+        '''
+        codes = {}
+        tag = [codes.setdefault(segment[3], len(codes)) for segment in segments]
+        table = cls([segment[0] for segment in segments], [segment[1] for segment in segments], tag, list(codes))
+        table.text = [segment[2] for segment in segments]
+        if segments and all(len(segment) > 4 for segment in segments):
+            table.sources = [np.asarray(segment[4], dtype=np.int64) for segment in segments]
+        return table
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def rows(self, ids=None):
+        '''
+        [[start, end, tag], ...] for the given row ids (all rows by default)
+        '''
+        ids = self.id if ids is None else ids
+        return [[self.start[i], self.end[i], self.tags[self.tag[i]]] for i in ids]
+
+    def ids_by_tag(self):
+        '''
+        {diarization tag: row ids} in diarization order
+        '''
+        return self._group(self.tag, self.tags)
+
+    def ids_by_speaker(self):
+        '''
+        {speaker name: row ids} in diarization order
+        '''
+        return self._group(self.speaker, self.names)
+
+    def _group(self, codes, labels):
+        # stable argsort keeps rows of each group in diarization order
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+        return {labels[code]: order[bounds[code]:bounds[code + 1]] for code in range(len(labels)) if bounds[code] < bounds[code + 1]}
+
+    def relabel(self, speaker_map):
+        '''
+        map diarization tags to speaker names ({tag: name}). tags that map to the same name are
+        merged into one speaker, except "unknown" which keeps one speaker per diarization tag.
+        '''
+        names = []
+        codes = {}
+        lut = np.empty(len(self.tags), dtype=np.int32)
+        for code, tag in enumerate(self.tags):
+            name = speaker_map.get(tag, tag)
+            if name == "unknown":
+                name = tag
+            if name not in codes:
+                codes[name] = len(names)
+                names.append(name)
+            lut[code] = codes[name]
+
+        self.names = names
+        self.speaker = lut[self.tag] if len(self.tag) else self.tag.copy()
+
+    def to_original_time(self, timemap, decimals=1):
+        '''
+        map start/end times from compacted audio (see vad.TimeMap) back to the original recording
+        '''
+        self.start = np.round(timemap.to_original(self.start), decimals)
+        self.end = np.round(timemap.to_original(self.end, end=True), decimals)
+
+    def speaker_of(self, i):
+        return self.names[self.speaker[i]]
+
+    def set_text(self, ids, texts):
+        for i, text in zip(ids, texts):
+            self.text[i] = text
+
+    def source_ids(self, i):
+        '''
+        ids of the original turns behind row i, None when the table was not coalesced
+        '''
+        return None if self.sources is None else [int(source) for source in self.sources[i]]
+
+    def to_list(self):
+        '''
+        [[start, end, text, speaker], ...] in diarization order, skipping rows without a transcript.
+        rows of a coalesced table get a fifth element, the ids of the original turns they cover
+        '''
+        segments = []
+        for i in self.id:
+            if self.text[i] is None:
+                continue
+            segment = [float(self.start[i]), float(self.end[i]), self.text[i], self.names[self.speaker[i]]]
+            if self.sources is not None:
+                segment.append(self.source_ids(i))
+            segments.append(segment)
+        return segments
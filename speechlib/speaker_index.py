@@ -0,0 +1,275 @@
+import os
+import json
+import threading
+import numpy as np
+
+'''
+index of enrollee embeddings for identification against large rosters.
+
+every enrollee is one L2 normalized row of a contiguous float32 matrix, so scoring N query
+embeddings against the whole roster is a single N x speakers matmul. the matrix grows by
+doubling its capacity, adding or replacing an enrollee writes one row and removing one moves
+the last row into its place, so the roster can change without rebuilding anything.
+
+with n_lists > 0 the index also keeps an IVF (inverted file) partition: the rows are clustered
+with spherical k-means into n_lists lists and a search only scores the rows of the n_probe
+lists closest to the query. every list keeps the array of its rows, so a search gathers only
+the rows of the probed lists. exact search is already fast for tens of thousands of enrollees;
+IVF keeps the cost of a search roughly constant beyond that, at the price of possibly missing
+a match that landed in a list that was not probed.
+
+save() and load() persist the index as one .npz file.
+'''
+
+INDEX_LISTS = int(os.environ.get("SPEECHLIB_INDEX_LISTS", 0))
+INDEX_PROBE = int(os.environ.get("SPEECHLIB_INDEX_PROBE", 8))
+
+# bump when the format of saved indexes changes
+INDEX_VERSION = 1
+
+
+def _normalize(embeddings):
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class SpeakerIndex:
+
+    def __init__(self, dim=None, n_lists=INDEX_LISTS, n_probe=INDEX_PROBE):
+        '''
+        dim: embedding size, taken from the first added embedding when None
+
+        n_lists: number of IVF lists, 0 for exact search only. the lists are trained by
+        ensure_trained() (or train()), which the first search calls as well
+
+        n_probe: lists scored per search
+        '''
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.names = []
+        self._rows = {}
+        self._size = 0
+        self._matrix = np.zeros((0, dim or 0), dtype=np.float32)
+        self._lists = None                              # n_lists x dim, L2 normalized
+        self._assignment = np.zeros(0, dtype=np.int32)  # IVF list of every row
+        self._members = []                              # rows of every IVF list
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    @property
+    def matrix(self):
+        '''
+        speakers x dim matrix of normalized embeddings, rows in the order of names
+        '''
+        return self._matrix[:self._size]
+
+    def _reserve(self, size):
+        if size <= len(self._matrix):
+            return
+        capacity = max(size, 2 * len(self._matrix), 64)
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        assignment = np.zeros(capacity, dtype=np.int32)
+        assignment[:self._size] = self._assignment[:self._size]
+        self._matrix = matrix
+        self._assignment = assignment
+
+    def add(self, name, embedding):
+        '''
+        add an enrollee, or replace the embedding of an existing one
+        '''
+        self.add_many([name], np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+
+    def add_many(self, names, embeddings):
+        embeddings = _normalize(np.atleast_2d(np.asarray(embeddings, dtype=np.float32)))
+        if len(names) != len(embeddings):
+            raise Exception(f"{len(names)} names for {len(embeddings)} embeddings")
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self._matrix = np.zeros((0, self.dim), dtype=np.float32)
+            if embeddings.shape[1] != self.dim:
+                raise Exception(f"embedding size {embeddings.shape[1]} does not match the index ({self.dim})")
+
+            self._reserve(self._size + len(names))
+            for name, embedding in zip(names, embeddings):
+                row = self._rows.get(name)
+                old_list = None
+                if row is None:
+                    row = self._size
+                    self._rows[name] = row
+                    self.names.append(name)
+                    self._size += 1
+                elif self._lists is not None:
+                    old_list = self._assignment[row]
+                self._matrix[row] = embedding
+                if self._lists is not None:
+                    new_list = int(np.argmax(self._lists @ embedding))
+                    if new_list != old_list:
+                        if old_list is not None:
+                            self._members[old_list].remove(row)
+                        self._members[new_list].append(row)
+                    self._assignment[row] = new_list
+
+    def remove(self, name):
+        '''
+        remove an enrollee. the last row takes its place
+        '''
+        with self._lock:
+            row = self._rows.pop(name)
+            last = self._size - 1
+            if self._lists is not None:
+                self._members[self._assignment[row]].remove(row)
+            if row != last:
+                moved = self.names[last]
+                self._matrix[row] = self._matrix[last]
+                self._assignment[row] = self._assignment[last]
+                self.names[row] = moved
+                self._rows[moved] = row
+                if self._lists is not None:
+                    members = self._members[self._assignment[row]]
+                    members[members.index(last)] = row
+            self.names.pop()
+            self._size -= 1
+
+    def embedding(self, name):
+        return self._matrix[self._rows[name]].copy()
+
+    def train(self, n_lists=None, iterations=10, seed=0):
+        '''
+        cluster the rows into n_lists IVF lists with spherical k-means
+        '''
+        with self._lock:
+            self.n_lists = n_lists or self.n_lists
+            matrix = self.matrix
+            if not self.n_lists or len(matrix) < self.n_lists:
+                self._lists = None
+                self._members = []
+                return self
+
+            rng = np.random.default_rng(seed)
+            lists = matrix[rng.choice(len(matrix), self.n_lists, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = np.argmax(matrix @ lists.T, axis=1)
+                sums = np.zeros_like(lists)
+                np.add.at(sums, assignment, matrix)
+                # empty lists keep their previous centroid
+                filled = np.bincount(assignment, minlength=self.n_lists) > 0
+                lists[filled] = _normalize(sums[filled])
+
+            self._lists = lists
+            self._assignment[:self._size] = np.argmax(matrix @ lists.T, axis=1)
+            self._group_members()
+        return self
+
+    def _group_members(self):
+        # rows of every list, from the assignment
+        assignment = self._assignment[:self._size]
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(self.n_lists + 1))
+        self._members = [order[bounds[i]:bounds[i + 1]].tolist() for i in range(self.n_lists)]
+
+    def ensure_trained(self):
+        '''
+        train the IVF lists if n_lists is set, they are not trained yet and the index holds at
+        least 4 * n_lists enrollees. returns True if the lists were trained
+        '''
+        with self._lock:
+            if self.n_lists and self._lists is None and self._size >= 4 * self.n_lists:
+                self.train()
+                return True
+        return False
+
+    def score(self, queries, rows=None):
+        '''
+        exact cosine similarity of every query (N x dim) against every enrollee (or the given rows)
+        '''
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        with self._lock:
+            if self._size == 0:
+                return np.zeros((len(queries), 0), dtype=np.float32)
+            matrix = self.matrix if rows is None else self._matrix[np.asarray(rows, dtype=np.int64)]
+            return queries @ matrix.T
+
+    def search(self, queries, k=1):
+        '''
+        the k best enrollees of every query. returns (scores, rows), both N x k and best first.
+        rows index names; missing results (fewer than k candidates) have row -1 and score -inf
+        '''
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+
+        with self._lock:
+            if self._size == 0:
+                return scores, rows
+
+            self.ensure_trained()
+
+            for i, query in enumerate(queries):
+                if self._lists is None:
+                    candidates = np.arange(self._size)
+                    candidate_scores = self.matrix @ query
+                else:
+                    probe = np.argsort(-(self._lists @ query))[:self.n_probe]
+                    candidates = np.fromiter((row for p in probe for row in self._members[p]), dtype=np.int64)
+                    candidate_scores = self._matrix[candidates] @ query
+
+                n = min(k, len(candidates))
+                if n == 0:
+                    continue
+                best = np.argpartition(-candidate_scores, n - 1)[:n]
+                best = best[np.argsort(-candidate_scores[best], kind="stable")]
+                scores[i, :n] = candidate_scores[best]
+                rows[i, :n] = candidates[best]
+
+        return scores, rows
+
+    def save(self, path, meta=None):
+        '''
+        write the index to path (.npz). meta is a json-able dict stored along with it
+        '''
+        with self._lock:
+            header = {"version": INDEX_VERSION, "dim": self.dim, "n_lists": self.n_lists, "n_probe": self.n_probe, "meta": meta}
+            arrays = {
+                "header": np.array(json.dumps(header)),
+                "names": np.array(self.names, dtype=str),
+                "matrix": self.matrix,
+                "assignment": self._assignment[:self._size],
+            }
+            if self._lists is not None:
+                arrays["lists"] = self._lists
+
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # write to a temporary file first so readers never see a partial index
+            tmp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        read an index written by save(). returns (index, meta)
+        '''
+        with np.load(path) as data:
+            header = json.loads(str(data["header"]))
+            if header.get("version") != INDEX_VERSION:
+                raise Exception(f"{path} has index version {header.get('version')}, expected {INDEX_VERSION}")
+
+            index = cls(header["dim"], header["n_lists"], header["n_probe"])
+            names = [str(name) for name in data["names"]]
+            if names:
+                index.add_many(names, data["matrix"])
+                index._assignment[:len(names)] = data["assignment"]
+            if "lists" in data:
+                index._lists = data["lists"].astype(np.float32)
+                index._group_members()
+
+        return index, header.get("meta")
@@ -1,117 +1,222 @@
 from speechbrain.pretrained import SpeakerRecognition
-import os
-from pydub import AudioSegment
-from collections import defaultdict
+import threading
+import logging
+import numpy as np
 import torch
-import time
-
-if torch.cuda.is_available():
-    verification = SpeakerRecognition.from_hparams(run_opts={"device":"cuda"}, source="speechbrain/spkrec-ecapa-voxceleb", savedir="pretrained_models/spkrec-ecapa-voxceleb")
-    print(f"Using CUDA for Speaker Recognition")
-else:
-    verification = SpeakerRecognition.from_hparams(run_opts={"device":"cpu"}, source="speechbrain/spkrec-ecapa-voxceleb", savedir="pretrained_models/spkrec-ecapa-voxceleb")
-    print(f"Using CPU for Speaker Recognition")
+from scipy.optimize import linear_sum_assignment
+from .voiceprint_store import (get_voiceprint_store)
+from .speaker_index import (_normalize)
+from .metrics import (span, incr)
+
+logger = logging.getLogger(__name__)
+
+ECAPA_MODEL = "speechbrain/spkrec-ecapa-voxceleb"
+
+# loaded on first use (see load_verification)
+verification = None
+verification_name = ECAPA_MODEL
+_verification_lock = threading.Lock()
+
+def load_verification():
+    global verification
+    if verification is None:
+        with _verification_lock:
+            if verification is None:
+                with span("load_model", model=ECAPA_MODEL):
+                    if torch.cuda.is_available():
+                        verification = SpeakerRecognition.from_hparams(run_opts={"device":"cuda"}, source=ECAPA_MODEL, savedir="pretrained_models/spkrec-ecapa-voxceleb")
+                        logger.info("Using CUDA for Speaker Recognition")
+                    else:
+                        verification = SpeakerRecognition.from_hparams(run_opts={"device":"cpu"}, source=ECAPA_MODEL, savedir="pretrained_models/spkrec-ecapa-voxceleb")
+                        logger.info("Using CPU for Speaker Recognition")
+                incr("model_loads")
+    return verification
+
+def set_verification(model, name):
+    '''
+    replace the ECAPA model by any object with load_audio(path) and encode_batch(wavs, wav_lens)
+    (e.g. a stub for offline benchmarks). name keeps voiceprint stores of different models apart
+    '''
+    global verification, verification_name
+    with _verification_lock:
+        verification = model
+        verification_name = name
 
-# recognize speaker name
-def speaker_recognition(file_name, voices_folder, segments, wildcards):
-    
-    if torch.cuda.is_available():
-        print(f"Using CUDA for Speaker Recognition")
-    else:
-        print(f"Using CPU for Speaker Recognition")
+def embedding_model_name():
+    return verification_name
 
-    speakers = os.listdir(voices_folder)
+def get_store(voices_folder):
+    # voiceprint store of voices_folder for the current embedding model
+    return get_voiceprint_store(voices_folder, embed_file, verification_name)
 
-    Id_count = defaultdict(int)
-    
-    start_time = int(time.time())
-    # Load the WAV file
-    audio = AudioSegment.from_file(file_name, format="wav")
-    end_time = int(time.time())
-    elapsed_time = int(end_time - start_time)
-    print(f"audio loaded. Time taken: {elapsed_time} seconds.")
+# same decision threshold as SpeakerRecognition.verify_files
+THRESHOLD = 0.25
 
-    folder_name = "/tmp"
+# ECAPA model is trained on 16 kHz audio
+EMBEDDING_SAMPLE_RATE = 16000
 
-    if not os.path.exists(folder_name):
-        os.makedirs(folder_name)
+# compute the ECAPA embedding of a wav file
+def embed_file(file):
+    model = load_verification()
+    signal = model.load_audio(file)
+    with torch.no_grad():
+        embedding = model.encode_batch(signal.unsqueeze(0))
+    return embedding.squeeze().cpu().numpy()
 
-    i = 0
-    
+def embed_segments(audio, segments, batch_size=16):
     '''
-    iterate over segments and check speaker for increased accuracy.
-    assign speaker name to arbitrary speaker tag 'SPEAKER_XX'
+    embed [start, end, ...] segments sliced from an AudioBuffer.
+    clips are zero padded into batches and embedded with one encode_batch call per batch.
+    returns a segments x dim numpy array.
     '''
-
-    limit = 60
-    duration = 0
-
+    clips = []
     for segment in segments:
-        
-        start_time = int(time.time())
-        
-        start = segment[0] * 1000   # start time in miliseconds
-        end = segment[1] * 1000     # end time in miliseconds
-        clip = audio[start:end]
-        i = i + 1
-        file = folder_name + "/" + file_name.split("/")[-1].split(".")[0] + "_segment"+ str(i) + ".wav"
-        clip.export(file, format="wav")
-        
-        end_time = int(time.time())
-        elapsed_time = int(end_time - start_time)
-        print(f"segment {i} exported. Time taken: {elapsed_time} seconds.")
-
-        max_score = 0
-        person = "unknown"      # if no match to any voice, then return unknown
-
-        for speaker in speakers:
-
-            #voices = os.listdir(voices_folder + "/" + speaker)
-            speaker_path = os.path.join(voices_folder, speaker)
+        clip = audio.torch(segment[0], segment[1], EMBEDDING_SAMPLE_RATE)[0]
+        if len(clip) == 0:
+            clip = torch.zeros(1)
+        clips.append(clip)
+
+    model = load_verification()
+    embeddings = []
+    for i in range(0, len(clips), batch_size):
+        batch = clips[i:i + batch_size]
+        lengths = torch.tensor([len(clip) for clip in batch], dtype=torch.float32)
+        padded = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True)
+
+        with torch.no_grad():
+            embedding = model.encode_batch(padded, lengths / lengths.max())
+        embeddings.append(embedding.squeeze(1).cpu().numpy())
+
+    incr("embeddings_computed", len(clips))
+    return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+# seconds of audio embedded per speaker at most
+RECOGNITION_BUDGET = 30.0
+# clips are cut to the middle MAX_CLIP seconds of a segment, longer clips add little to an ECAPA embedding
+MAX_CLIP = 10.0
+# segments shorter than this are only used when there is not enough longer speech
+MIN_SEGMENT = 1.0
+# a speaker stops embedding once its best enrollee leads the runner-up by this much, after at least MIN_EVIDENCE seconds
+MARGIN = 0.1
+MIN_EVIDENCE = 3.0
+
+def select_segments(segments, budget_seconds=RECOGNITION_BUDGET, max_clip=MAX_CLIP, min_segment=MIN_SEGMENT):
+    '''
+    pick the clips used to recognize a speaker: longest segments first, cut to max_clip seconds
+    around their middle, until budget_seconds of audio are selected.
+    returns [[start, end], ...] in the order they should be embedded
+    '''
+    if not segments:
+        return []
 
-            # Ensure we only get files, avoiding directories
-            voices = [
-                v for v in os.listdir(speaker_path) 
-                if os.path.isfile(os.path.join(speaker_path, v))
-            ]
+    start = np.array([segment[0] for segment in segments], dtype=np.float64)
+    end = np.array([segment[1] for segment in segments], dtype=np.float64)
+    duration = end - start
 
-            for voice in voices:
-                voice_file = voices_folder + "/" + speaker + "/" + voice
+    # longest first, short segments only after every long one
+    order = np.argsort(-duration, kind="stable")
+    order = np.concatenate([order[duration[order] >= min_segment], order[duration[order] < min_segment]])
 
-                try:
-                    start_time = int(time.time())
-                    # compare voice file with audio file
-                    score, prediction = verification.verify_files(voice_file, file)
-                    prediction = prediction[0].item()
-                    score = score[0].item()
-                    end_time = int(time.time())
-                    elapsed_time = int(end_time - start_time)
-                    print(f"speaker {speaker} compared. Time taken: {elapsed_time} seconds.")
-
-                    if prediction == True:
-                        if score >= max_score:
-                            max_score = score
-                            speakerId = speaker.split(".")[0]  
-                            if speakerId not in wildcards:        # speaker_00 cannot be speaker_01
-                                person = speakerId
-                except Exception as err:
-                    print("error occured while speaker recognition: ", err)
+    clips = []
+    total = 0.0
+    for i in order:
+        if total >= budget_seconds or duration[i] <= 0:
+            break
+        length = min(duration[i], max_clip, budget_seconds - total)
+        clip_start = start[i] + (duration[i] - length) / 2
+        clips.append([round(float(clip_start), 3), round(float(clip_start + length), 3)])
+        total += length
 
-        Id_count[person] += 1
+    return clips
 
-        # Delete the WAV file after processing
-        os.remove(file)
+def recognize_speakers(voices_folder, segments_by_tag, audio, embedding_cache=None, budget_seconds=RECOGNITION_BUDGET, threshold=THRESHOLD, batch_size=16, margin=MARGIN):
+    '''
+    name every diarized speaker at once.
 
-        current_pred = max(Id_count, key=Id_count.get)
+    segments_by_tag: {diarization tag: [[start, end, ...], ...]}
 
-        duration += (end - start)
-        if duration >= limit and current_pred != "unknown":
-            break
-    
-    most_common_Id = max(Id_count, key=Id_count.get)
-    return most_common_Id
+    every speaker gets one centroid embedding (duration weighted mean of its clips, see select_segments).
+    clips are embedded longest first in rounds shared by all speakers, and a speaker stops once its
+    centroid leads the runner-up enrollee by margin after MIN_EVIDENCE seconds, so clear speakers
+    do not spend the whole budget.
 
+    the speakers x enrollees cosine matrix is computed with one matmul and speakers are assigned to
+    enrollees with the Hungarian algorithm, so every enrollee names at most one speaker and the result
+    does not depend on the order of the speakers. speakers whose assigned score is not above threshold
+    are "unknown".
 
+    returns {diarization tag: name}
+    '''
+    tags = list(segments_by_tag)
+    names = {tag: "unknown" for tag in tags}
+
+    store = get_store(voices_folder)
+    if not tags or not store.speakers:
+        return names
+
+    if embedding_cache is None:
+        embedding_cache = {}
+
+    clips = {tag: select_segments(segments_by_tag[tag], budget_seconds) for tag in tags}
+    embedded = {tag: 0 for tag in tags}         # clips of every speaker embedded so far
+    centroids = {}
+    weights = {tag: 0.0 for tag in tags}
+    pending = [tag for tag in tags if clips[tag]]
+
+    while pending:
+        # the next clips of all pending speakers are embedded together so batches stay full
+        per_speaker = max(1, batch_size // len(pending))
+        batch = {tag: clips[tag][embedded[tag]:embedded[tag] + per_speaker] for tag in pending}
+        missing = list({(clip[0], clip[1]) for tag in pending for clip in batch[tag] if (clip[0], clip[1]) not in embedding_cache})
+        if missing:
+            try:
+                with span("embed"):
+                    for clip, embedding in zip(missing, embed_segments(audio, missing, batch_size)):
+                        embedding_cache[clip] = embedding
+            except Exception as err:
+                incr("embedding_errors")
+                logger.warning("error occured while speaker recognition: %s", err)
+                return names
+
+        with span("score"):
+            for tag in pending:
+                embeddings = _normalize(np.stack([embedding_cache[(clip[0], clip[1])] for clip in batch[tag]]).astype(np.float32))
+                durations = np.array([clip[1] - clip[0] for clip in batch[tag]], dtype=np.float32)
+                centroids[tag] = centroids.get(tag, 0) + durations @ embeddings
+                weights[tag] += float(durations.sum())
+                embedded[tag] += len(batch[tag])
+            incr("recognition_seconds", float(sum(clip[1] - clip[0] for tag in pending for clip in batch[tag])))
+
+            # stop a speaker once its best enrollee is clear
+            top, _ = store.search(np.stack([centroids[tag] for tag in pending]), k=2)
+            clear = (top[:, 0] > threshold) & (top[:, 0] - top[:, 1] >= margin)
+            pending = [tag for tag, stop in zip(pending, clear)
+                       if embedded[tag] < len(clips[tag]) and not (stop and weights[tag] >= MIN_EVIDENCE)]
+
+    known = [tag for tag in tags if tag in centroids]
+    if not known:
+        return names
+
+    with span("score"):
+        centroids = np.stack([centroids[tag] for tag in known])
+
+        # an optimal assignment only uses each speaker's len(known) best enrollees, so the matrix
+        # is built over their union instead of the whole roster
+        _, best = store.search(centroids, k=min(len(known), len(store.speakers)))
+        candidates = np.unique(best[best >= 0])
+        scores = store.index.score(centroids, candidates)
+
+        # maximize the total score of the assigned pairs. scores not above threshold can never name a
+        # speaker, so they count as 0 and can not pull a confident match away from its enrollee
+        rows, cols = linear_sum_assignment(-np.where(scores > threshold, scores, 0))
+
+    for row, col in zip(rows, cols):
+        speaker = store.speakers[candidates[col]]
+        logger.debug("speaker %s best matches %s (%.3f, %.1fs)", known[row], speaker, scores[row, col], weights[known[row]])
+        if scores[row, col] > threshold:
+            names[known[row]] = speaker
+
+    return names
 
 '''
 from speechbrain.pretrained import SpeakerRecognition
@@ -120,7 +225,6 @@ from pydub import AudioSegment
 from collections import defaultdict
 import torch
 import io
-import torchaudio
 
 # Initialize Speaker Recognition model
 if torch.cuda.is_available():
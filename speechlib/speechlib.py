@@ -2,10 +2,15 @@ from .core_analysis import (core_analysis)
 from .re_encode import (re_encode)
 from .convert_to_mono import (convert_to_mono)
 from .convert_to_wav import (convert_to_wav)
+from .preprocess import (preprocess, preprocess_to_file)
+from .diarization import (preload_diarization)
+from .batch import (transcribe_many)
+from .writers import (open_writers)
+from .stream import (SegmentStream)
 
 class Transcriptor:
 
-    def __init__(self, file, log_folder, language, modelSize, ACCESS_TOKEN, voices_folder=None, quantization=False):
+    def __init__(self, file, log_folder, language, modelSize, ACCESS_TOKEN, voices_folder=None, quantization=False, diarization_model=None, concurrency=None, max_workers=None, long_audio=False, window_seconds=600, overlap_seconds=30, strategy="segments", coalesce=None, result_cache=None, diarization_cache=None, vad=None, outputs=None):
         '''
         transcribe a wav file 
         
@@ -25,6 +30,37 @@ class Transcriptor:
 
         quantization: whether to use int8 quantization or not (default=False)
 
+        diarization_model: huggingface id or local directory of the pyannote pipeline (default: pyannote/speaker-diarization@2.1)
+
+        concurrency: "none", "thread" or "process". transcribe segments in a bounded worker pool (default=None, sequential)
+
+        max_workers: size of the worker pool (default: SPEECHLIB_MAX_WORKERS, 4, at most the number of cpu cores)
+
+        long_audio: process the file in overlapping windows so memory stays bounded on multi-hour recordings (default=False)
+
+        window_seconds, overlap_seconds: window length and overlap used when long_audio is True (default 600 and 30)
+
+        strategy: "segments" transcribes every diarized turn separately, "whole_file" transcribes the file once
+        with word timestamps and aligns the words to the turns (whisper, faster-whisper and custom models only)
+
+        coalesce: merge short and back-to-back turns of the same speaker before transcription. True for the defaults
+        or a dict with max_gap (0.5 s), min_duration (0.5 s), max_duration (30 s) and drop_short (False).
+        every segment then carries a fifth element, the ids of the diarized turns it was merged from
+
+        result_cache: True, a folder or a ResultCache. a file whose decoded audio and settings were transcribed
+        before returns the stored result right away (default=None, no cache)
+
+        diarization_cache: True or a folder. diarization turns are stored per decoded audio and pipeline version,
+        so reruns of a file with another model or voices folder skip diarization (default=None, no cache)
+
+        vad: drop silence before diarization with an energy based voice activity detector. True for the defaults or a dict
+        with threshold_db (adaptive), margin_db (12), min_speech (0.25 s), min_silence (0.5 s) and padding (0.2 s).
+        timestamps always refer to the original file (default=None)
+
+        outputs: extra output formats written while the job runs: "jsonl", "srt", "vtt" and/or "rttm". every segment is
+        appended as soon as it is transcribed. the exact files are in output_paths once a transcription has started,
+        together with the transcript log under "log" when it is done (default=None)
+
         see documentation: https://github.com/Navodplayer1/speechlib
         
             
@@ -237,25 +273,99 @@ class Transcriptor:
         self.modelSize = modelSize
         self.quantization = quantization
         self.ACCESS_TOKEN = ACCESS_TOKEN
+        self.diarization_model = diarization_model
+        self.concurrency = concurrency
+        self.max_workers = max_workers
+        self.long_audio = long_audio
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.strategy = strategy
+        self.coalesce = coalesce
+        self.result_cache = result_cache
+        self.diarization_cache = diarization_cache
+        self.vad = vad
+        self.outputs = outputs
+        self.output_paths = {}
+
+    @staticmethod
+    def preload(ACCESS_TOKEN, diarization_model=None, replicas=None):
+        '''
+        load the diarization pipeline once so later transcriptions do not pay the load time
+
+        replicas: worker replicas that each get their own pipeline (e.g. JobQueue.replicas), default the calling thread
+        '''
+        preload_diarization(ACCESS_TOKEN, diarization_model, replicas)
+
+    def transcribe_many(self, paths, model_type="faster-whisper", workers=1, custom_model_path=None, hf_model_id=None, aai_api_key=None, progress=None, report_file=None):
+        '''
+        transcribe many files with the settings of this Transcriptor (its file is not used and can be None)
+
+        paths: list of files, a directory of audio files or a manifest file (one path per line)
+
+        model_type: "faster-whisper", "whisper", "custom", "huggingface" or "assemblyAI"
+
+        workers: number of worker processes, each one loads the models once (0 runs in this process)
+
+        progress: optional callback(result, BatchProgress) called after every file
+
+        report_file: optional JSON lines file that gets one result per file
+
+        returns one dict per file: {"path", "ok", "segments", "error", "seconds", "audio_seconds", "worker", "outputs"}.
+        a failing file does not stop the batch
+        '''
+        return transcribe_many(paths, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, model_type, self.voices_folder, self.quantization,
+                               custom_model_path, hf_model_id, aai_api_key, self.diarization_model, self.concurrency, self.max_workers,
+                               self.long_audio, self.window_seconds, self.overlap_seconds, self.strategy, self.coalesce, self.result_cache, self.diarization_cache, self.vad, self.outputs,
+                               workers=workers, progress=progress, report_file=report_file)
+
+    def _run(self, model_type, custom_model_path=None, hf_model_id=None, aai_api_key=None, listener=None):
+        # output_paths is filled in place, so a reference taken before the call sees the paths of this run
+        self.output_paths.clear()
+        writers = None
+        if self.outputs or listener is not None:
+            writers = open_writers(self.outputs or [], self.log_folder, self.file, self.language, self.output_paths)
+            if listener is not None:
+                writers.add_listener(listener)
+        try:
+            return core_analysis(self.file, self.voices_folder, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, model_type, self.quantization, custom_model_path, hf_model_id, aai_api_key,
+                                 diarization_model=self.diarization_model, concurrency=self.concurrency, max_workers=self.max_workers, long_audio=self.long_audio, window_seconds=self.window_seconds,
+                                 overlap_seconds=self.overlap_seconds, strategy=self.strategy, coalesce=self.coalesce, result_cache=self.result_cache, diarization_cache=self.diarization_cache,
+                                 vad=self.vad, writers=writers)
+        finally:
+            if writers is not None:
+                writers.close()
+
+    def stream(self, model_type="faster-whisper", custom_model_path=None, hf_model_id=None, aai_api_key=None):
+        '''
+        start the transcription in a background thread and return a SegmentStream. iterating it (for or async for)
+        yields (start, end, text, speaker) tuples in time order as soon as they are transcribed, instead of
+        waiting for the whole file. with long_audio segments arrive window by window.
+
+        model_type: "faster-whisper", "whisper", "custom", "huggingface" or "assemblyAI"
+
+        the complete result is in stream.result after the last segment. the transcription keeps running
+        when the iteration is stopped early
+        '''
+        return SegmentStream(lambda listener: self._run(model_type, custom_model_path, hf_model_id, aai_api_key, listener))
 
     def whisper(self):
-        res = core_analysis(self.file, self.voices_folder, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, "whisper", self.quantization)
+        res = self._run("whisper")
         return res
     
     def faster_whisper(self):
-        res = core_analysis(self.file, self.voices_folder, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, "faster-whisper", self.quantization)
+        res = self._run("faster-whisper")
         return res
 
     def custom_whisper(self, custom_model_path):
-        res = core_analysis(self.file, self.voices_folder, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, "custom", self.quantization, custom_model_path)
+        res = self._run("custom", custom_model_path)
         return res
     
     def huggingface_model(self, hf_model_id):
-        res = core_analysis(self.file, self.voices_folder, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, "huggingface", self.quantization, None, hf_model_id)
+        res = self._run("huggingface", hf_model_id=hf_model_id)
         return res
     
     def assemby_ai_model(self, aai_api_key):
-        res = core_analysis(self.file, self.voices_folder, self.log_folder, self.language, self.modelSize, self.ACCESS_TOKEN, "assemblyAI", self.quantization, None, None, aai_api_key)
+        res = self._run("assemblyAI", aai_api_key=aai_api_key)
         return res
 
 class PreProcessor:
@@ -270,6 +380,10 @@ class PreProcessor:
 
     mp3_to_wav(file) -> convert mp3 file to wav format  
 
+    preprocess(file) -> convert any file to 16 kHz mono 16-bit audio in one pass, returns an in-memory AudioBuffer  
+
+    preprocess_to_file(file, output_folder) -> same as preprocess but writes a cached wav file and returns its path  
+
     '''
 
     def re_encode(self, file):
@@ -281,3 +395,10 @@ class PreProcessor:
     def convert_to_wav(self, file):
         path = convert_to_wav(file)
         return path
+
+    def preprocess(self, file):
+        return preprocess(file)
+
+    def preprocess_to_file(self, file, output_folder=".speechlib_cache"):
+        path = preprocess_to_file(file, output_folder)
+        return path
@@ -0,0 +1,67 @@
+import queue
+import asyncio
+import threading
+from .executor import (worker_replica, set_worker_replica)
+
+'''
+segments of a transcription as they are transcribed.
+
+the transcription runs in a background thread and hands every finished segment to a queue
+(through the same path as the output writers, so segments arrive in time order). iterating
+the stream yields (start, end, text, speaker) tuples from that queue, so the first segments
+are available while later ones are still being transcribed. async for works as well, the
+queue is then read from the event loop's default executor.
+'''
+
+_DONE = object()
+
+
+class SegmentStream:
+    '''
+    iterator over the (start, end, text, speaker) segments of a transcription running in a background thread.
+
+    after the last segment, result holds the complete common_segments list. an error of the
+    transcription is raised by the iterator once the segments before it were yielded
+    '''
+
+    def __init__(self, run):
+        '''
+        run: function taking a listener(segment) and returning the common_segments
+        '''
+        self.result = None
+        self.error = None
+        self._queue = queue.Queue()
+        # the background thread uses the models of the calling thread (see executor.worker_replica)
+        self._thread = threading.Thread(target=self._run, args=(run, worker_replica()), name="speechlib-stream", daemon=True)
+        self._thread.start()
+
+    def _run(self, run, replica):
+        set_worker_replica(replica)
+        try:
+            self.result = run(self._queue.put)
+        except Exception as err:
+            self.error = err
+        finally:
+            self._queue.put(_DONE)
+
+    def __iter__(self):
+        while True:
+            segment = self._queue.get()
+            if segment is _DONE:
+                break
+            yield segment
+
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            segment = await loop.run_in_executor(None, self._queue.get)
+            if segment is _DONE:
+                break
+            yield segment
+
+        if self.error is not None:
+            raise self.error
@@ -1,28 +1,158 @@
 import torch
-from .whisper_sinhala import (whisper_sinhala)
+import logging
+from .whisper_sinhala import (whisper_sinhala, load_sinhala_pipeline)
+from .model_registry import (get_model)
+from .executor import (worker_replica)
+from .assemblyai_async import (transcribe_assemblyai)
+from .metrics import (incr)
 from faster_whisper import WhisperModel
 import whisper
 import os
+import io
+import wave
+import numpy as np
 from transformers import pipeline
 import assemblyai as aai
 
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+MODEL_SIZES = ["base", "tiny", "small", "medium", "large", "large-v1", "large-v2", "large-v3"]
+
+# extra model types, {model_type: fn(audios, language, model_size) -> texts}
+_backends = {}
+
+def register_backend(model_type, fn):
+    '''
+    make transcribe_batch route model_type to fn, e.g. a stub backend for offline benchmarks.
+    fn gets a list of 16 kHz float32 arrays, the language and the model size and returns one text per array
+    '''
+    _backends[model_type] = fn
+
+def load_faster_whisper(model_size, quantization, num_workers=1):
+    if torch.cuda.is_available():
+        device = "cuda"
+        compute_type = "int8_float16" if quantization else "float16"
+    else:
+        device = "cpu"
+        compute_type = "int8" if quantization else "float32"
+
+    # one CTranslate2 model serves num_workers concurrent transcribe() calls,
+    # so split the cpu threads between them instead of oversubscribing
+    cpu_threads = max(1, (os.cpu_count() or 1) // num_workers) if num_workers > 1 else 0
+
+    return get_model("faster-whisper", model_size, device, f"{compute_type}/{num_workers}",
+                     lambda: WhisperModel(model_size, device=device, compute_type=compute_type, cpu_threads=cpu_threads, num_workers=num_workers))
+
+def load_whisper(model_size, download_root=None):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # torch models are not safe to share between threads, each worker thread gets its own
+    return get_model("whisper", model_size, device, "float16" if device == "cuda" else "float32",
+                     lambda: whisper.load_model(model_size, download_root=download_root, device=device), worker_replica())
+
+def load_hf_pipeline(hf_model_path):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    return get_model("huggingface", hf_model_path, device, "default",
+                     lambda: pipeline("automatic-speech-recognition", model=hf_model_path, device=device), worker_replica())
+
+def preload_asr(language, model_size, model_type, quantization=False, custom_model_path=None, hf_model_path=None, num_workers=1):
+    '''
+    load the ASR model transcribe_batch would use for these settings into the model registry
+    '''
+    if model_type in _backends or model_type == "assemblyAI":
+        return None
+    elif language in ["si", "Si"]:
+        return load_sinhala_pipeline()
+    elif model_type == "faster-whisper":
+        return load_faster_whisper(model_size, quantization, num_workers)
+    elif model_type == "whisper":
+        return load_whisper(model_size)
+    elif model_type == "custom":
+        return load_whisper(custom_model_path, download_root=os.path.dirname(custom_model_path) + "/")
+    elif model_type == "huggingface":
+        return load_hf_pipeline(hf_model_path)
+    else:
+        raise Exception(f"model_type {model_type} is not supported")
+
+def array_to_wav_bytes(audio):
+    '''
+    encode a 16 kHz float32 array as an in-memory 16-bit PCM wav file
+    '''
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(pcm.tobytes())
+    buffer.seek(0)
+    return buffer
+
+def transcribe_batch(audios, language, model_size, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size=8, num_workers=1):
+    '''
+    transcribe a batch of 16 kHz mono float32 numpy arrays without touching the filesystem.
+    returns one transcript per array, in the same order (None for assemblyAI clips that failed).
+
+    num_workers: number of threads that call this concurrently (used to size the shared faster-whisper model)
+    '''
+    if model_type in _backends:
+        return _backends[model_type](audios, language, model_size)
+    elif language in ["si", "Si"]:
+        pipe = load_sinhala_pipeline()
+        results = pipe([{"raw": audio, "sampling_rate": SAMPLE_RATE} for audio in audios], batch_size=batch_size)
+        return [result["text"] for result in results]
+    elif model_size not in MODEL_SIZES:
+        raise Exception("only 'base', 'tiny', 'small', 'medium', 'large', 'large-v1', 'large-v2', 'large-v3' models are available.")
+
+    if model_type == "faster-whisper":
+        model = load_faster_whisper(model_size, quantization, num_workers)
+
+        if language not in model.supported_languages:
+            raise Exception("Language code not supported.\nThese are the supported languages:\n", model.supported_languages)
+
+        texts = []
+        for audio in audios:
+            segments, info = model.transcribe(audio, language=language, beam_size=5)
+            texts.append("".join(segment.text + " " for segment in segments))
+        return texts
+    elif model_type in ["whisper", "custom"]:
+        if model_type == "custom":
+            model = load_whisper(custom_model_path, download_root=os.path.dirname(custom_model_path) + "/")
+        else:
+            model = load_whisper(model_size)
+
+        # whisper accepts arrays directly, which skips the ffmpeg decode of every clip
+        return [model.transcribe(audio, language=language, fp16=torch.cuda.is_available())["text"] for audio in audios]
+    elif model_type == "huggingface":
+        pipe = load_hf_pipeline(hf_model_path)
+        results = pipe([{"raw": audio, "sampling_rate": SAMPLE_RATE} for audio in audios], batch_size=batch_size)
+        return [result["text"] for result in results]
+    elif model_type == "assemblyAI":
+        # submit every clip first, then poll them together with a bounded number of requests in flight
+        results = transcribe_assemblyai([array_to_wav_bytes(audio).getvalue() for audio in audios], aai_api_key, language)
+
+        texts = []
+        for result in results:
+            if isinstance(result, Exception):
+                incr("transcription_errors")
+                logger.warning("an error occured while transcribing: %s", result)
+                texts.append(None)
+            else:
+                texts.append(result)
+        return texts
+    else:
+        raise Exception(f"model_type {model_type} is not supported")
+
 def transcribe(file, language, model_size, model_type, quantization, custom_model_path, hf_model_path, aai_api_key):
     res = ""
     if language in ["si", "Si"]:
         res = whisper_sinhala(file)
         return res
-    elif model_size in ["base", "tiny", "small", "medium", "large", "large-v1", "large-v2", "large-v3"]:
+    elif model_size in MODEL_SIZES:
         if model_type == "faster-whisper":
-            if torch.cuda.is_available():
-                if quantization:
-                    model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
-                else:
-                    model = WhisperModel(model_size, device="cuda", compute_type="float16")
-            else:
-                if quantization:
-                    model = WhisperModel(model_size, device="cpu", compute_type="int8")
-                else:
-                    model = WhisperModel(model_size, device="cpu", compute_type="float32")
+            model = load_faster_whisper(model_size, quantization)
 
             if language in model.supported_languages:
                 segments, info = model.transcribe(file, language=language, beam_size=5)
@@ -32,49 +162,34 @@ def transcribe(file, language, model_size, model_type, quantization, custom_mode
                     
                 return res
             else:
-                Exception("Language code not supported.\nThese are the supported languages:\n", model.supported_languages)
+                raise Exception("Language code not supported.\nThese are the supported languages:\n", model.supported_languages)
         elif model_type == "whisper":
             try:
-                if torch.cuda.is_available():
-                    model = whisper.load_model(model_size, device="cuda")
-                    result = model.transcribe(file, language=language, fp16=True)
-                    res = result["text"]
-                else:
-                    model = whisper.load_model(model_size, device="cpu")
-                    result = model.transcribe(file, language=language, fp16=False)
-                    res = result["text"]
+                model = load_whisper(model_size)
+                result = model.transcribe(file, language=language, fp16=torch.cuda.is_available())
+                res = result["text"]
 
                 return res
             except Exception as err:
-                print("an error occured while transcribing: ", err)
+                logger.error("an error occured while transcribing: %s", err)
         elif model_type == "custom":
             model_folder = os.path.dirname(custom_model_path)
             model_folder = model_folder + "/"
-            print("model file: ", custom_model_path)
-            print("model fodler: ", model_folder)
+            logger.debug("model file: %s", custom_model_path)
+            logger.debug("model folder: %s", model_folder)
             try:
-                if torch.cuda.is_available():
-                    model = whisper.load_model(custom_model_path, download_root=model_folder, device="cuda")
-                    result = model.transcribe(file, language=language, fp16=True)
-                    res = result["text"]
-                else:
-                    model = whisper.load_model(custom_model_path, download_root=model_folder, device="cpu")
-                    result = model.transcribe(file, language=language, fp16=False)
-                    res = result["text"]
+                model = load_whisper(custom_model_path, download_root=model_folder)
+                result = model.transcribe(file, language=language, fp16=torch.cuda.is_available())
+                res = result["text"]
 
                 return res
             except Exception as err:
                 raise Exception(f"an error occured while transcribing: {err}")
         elif model_type == "huggingface":
             try:
-                if torch.cuda.is_available():
-                    pipe = pipeline("automatic-speech-recognition", model=hf_model_path, device="cuda")
-                    result = pipe(file)
-                    res = result['text']
-                else:
-                    pipe = pipeline("automatic-speech-recognition", model=hf_model_path, device="cpu")
-                    result = pipe(file)
-                    res = result['text']
+                pipe = load_hf_pipeline(hf_model_path)
+                result = pipe(file)
+                res = result['text']
                 return res
             except Exception as err:
                 raise Exception(f"an error occured while transcribing: {err}")
@@ -93,7 +208,6 @@ def transcribe(file, language, model_size, model_type, quantization, custom_mode
                 transcript = transcriber.transcribe(file)
 
                 if transcript.status == aai.TranscriptStatus.error:
-                    print(transcript.error)
                     raise Exception(f"an error occured while transcribing: {transcript.error}")
                 else:
                     res = transcript.text
@@ -104,4 +218,3 @@ def transcribe(file, language, model_size, model_type, quantization, custom_mode
             raise Exception(f"model_type {model_type} is not supported")
     else:
         raise Exception("only 'base', 'tiny', 'small', 'medium', 'large', 'large-v1', 'large-v2', 'large-v3' models are available.")
-
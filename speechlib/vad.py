@@ -0,0 +1,160 @@
+import logging
+import numpy as np
+from .audio_buffer import (AudioBuffer)
+
+'''
+energy based voice activity detection used to drop silence before diarization.
+
+the preprocessed audio is cut into short frames and the energy of every frame is computed with
+one vectorized pass per block of frames. frames above an adaptive threshold (noise floor +
+margin, but never above the loudest frame - 20 dB nor closer than MIN_MARGIN_DB to the noise
+floor) are speech; short pauses inside speech are
+filled, speech blips shorter than min_speech are dropped and every region is padded so word
+onsets are not clipped.
+
+the speech regions are concatenated into a compact AudioBuffer, and a TimeMap maps timestamps
+of the compact audio back to the original recording. stages that run over the whole timeline
+(diarization, whole-file ASR) then cost time proportional to the speech they contain instead
+of the length of the recording.
+
+steady background noise or hold music that is not louder than MAX_THRESHOLD_DB sets the noise
+floor and is removed like silence; speech over it is kept as long as it rises above the threshold.
+'''
+
+logger = logging.getLogger(__name__)
+
+# never treat frames louder than this (dBFS) as silence, whatever the noise floor
+MAX_THRESHOLD_DB = -20.0
+# frames quieter than this (dBFS) are always silence
+MIN_THRESHOLD_DB = -60.0
+# the adaptive threshold stays at least this far above the noise floor
+MIN_MARGIN_DB = 6.0
+
+
+def frame_energy_db(samples, frame, block_frames=4096):
+    '''
+    energy in dBFS of every frame of int16 samples (the last partial frame included)
+    '''
+    n_frames = -(-len(samples) // frame)
+    energy = np.empty(n_frames, dtype=np.float64)
+
+    full = len(samples) // frame
+    for i in range(0, full, block_frames):
+        j = min(i + block_frames, full)
+        frames = samples[i * frame:j * frame].reshape(j - i, frame).astype(np.float32)
+        energy[i:j] = np.einsum("ij,ij->i", frames, frames) / frame
+
+    if n_frames > full:
+        tail = samples[full * frame:].astype(np.float32)
+        energy[full] = np.dot(tail, tail) / len(tail)
+
+    return 10 * np.log10(energy / (32768.0 ** 2) + 1e-12)
+
+
+def _runs(mask):
+    # (starts, ends) of the runs of True in a boolean array, ends exclusive
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _merge_close(starts, ends, min_gap):
+    # join runs separated by fewer than min_gap frames
+    if len(starts) < 2:
+        return starts, ends
+    keep = starts[1:] - ends[:-1] >= min_gap
+    return starts[np.concatenate([[True], keep])], ends[np.concatenate([keep, [True]])]
+
+
+def energy_vad(samples, sample_rate, frame_ms=30, threshold_db=None, margin_db=12.0, min_speech=0.25, min_silence=0.5, padding=0.2):
+    '''
+    speech regions of int16 samples as an (N, 2) array of [start, end) sample indices
+
+    threshold_db: fixed threshold in dBFS, adaptive when None
+
+    margin_db: adaptive threshold above the noise floor (10th percentile of frame energies)
+
+    min_speech, min_silence, padding: in seconds
+    '''
+    frame = max(1, int(sample_rate * frame_ms / 1000))
+    if len(samples) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    energy = frame_energy_db(samples, frame)
+
+    if threshold_db is None:
+        # the loudest frame, not a percentile: in a mostly silent recording every percentile is silence
+        floor, loud = np.percentile(energy, 10), energy.max()
+        threshold_db = max(min(floor + margin_db, loud - 20.0), floor + MIN_MARGIN_DB)
+        threshold_db = max(min(threshold_db, MAX_THRESHOLD_DB), MIN_THRESHOLD_DB)
+
+    starts, ends = _runs(energy > threshold_db)
+    starts, ends = _merge_close(starts, ends, int(np.ceil(min_silence * 1000 / frame_ms)))
+
+    long_enough = (ends - starts) * frame_ms / 1000 >= min_speech
+    starts, ends = starts[long_enough], ends[long_enough]
+
+    pad = int(np.ceil(padding * 1000 / frame_ms))
+    starts = np.maximum(starts - pad, 0)
+    ends = np.minimum(ends + pad, len(energy))
+    starts, ends = _merge_close(starts, ends, 1)
+
+    regions = np.stack([starts * frame, np.minimum(ends * frame, len(samples))], axis=1).astype(np.int64)
+    return regions.reshape(-1, 2)
+
+
+class TimeMap:
+    '''
+    maps times of the compacted audio (speech regions back to back) to times of the original audio
+    '''
+
+    def __init__(self, regions, sample_rate):
+        '''
+        regions: (N, 2) array of [start, end) sample indices of the kept regions in the original audio
+        '''
+        self.regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+        self.sample_rate = sample_rate
+        lengths = self.regions[:, 1] - self.regions[:, 0]
+        self.compact_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    @property
+    def speech_seconds(self):
+        return float((self.regions[:, 1] - self.regions[:, 0]).sum()) / self.sample_rate
+
+    def to_original(self, times, end=False):
+        '''
+        original times (seconds) of compact times (seconds). with end=True a time on the border of two
+        regions maps to the end of the first one instead of the start of the second
+        '''
+        times = np.asarray(times, dtype=np.float64)
+        if not len(self.regions):
+            return times
+        samples = times * self.sample_rate
+        index = np.searchsorted(self.compact_starts, samples, side="left" if end else "right") - 1
+        index = np.clip(index, 0, len(self.regions) - 1)
+        return (self.regions[index, 0] + samples - self.compact_starts[index]) / self.sample_rate
+
+
+def apply_vad(audio, **options):
+    '''
+    drop the non-speech regions of an AudioBuffer. returns (compact AudioBuffer, TimeMap, stats).
+    audio without any detected speech is returned unchanged
+    '''
+    regions = energy_vad(audio.samples, audio.sample_rate, **options)
+    if not len(regions):
+        regions = np.array([[0, len(audio.samples)]], dtype=np.int64)
+
+    timemap = TimeMap(regions, audio.sample_rate)
+    if len(regions) == 1 and regions[0, 0] == 0 and regions[0, 1] == len(audio.samples):
+        compact = audio
+    else:
+        compact = AudioBuffer(np.concatenate([audio.samples[start:end] for start, end in regions]), audio.sample_rate)
+
+    stats = {
+        "duration": audio.duration,
+        "speech_seconds": compact.duration,
+        "skipped_seconds": audio.duration - compact.duration,
+        "regions": len(regions),
+    }
+    if stats["skipped_seconds"] == 0:
+        logger.warning("vad found no silence to skip in %.1fs of audio", audio.duration)
+    return compact, timemap, stats
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import defaultdict
+import numpy as np
+from .speaker_index import (SpeakerIndex, _normalize, INDEX_LISTS, INDEX_PROBE)
+from .metrics import (incr)
+
+'''
+persistent store of enrollment embeddings for a voices_folder.
+
+embeddings of every enrollment file are kept in <voices_folder>/.voiceprints/embeddings.npy
+(memory-mapped on load) together with a manifest.json that records the path, speaker,
+mtime, size and sha1 of each file. on refresh only new or changed files are embedded again:
+a file whose mtime and size are unchanged is reused as is, and a file whose mtime changed
+but whose content hash did not is reused as well.
+
+one normalized centroid per enrollee is derived from the file embeddings and kept in a
+SpeakerIndex (<voices_folder>/.voiceprints/index.npz), so a single matmul scores segments against
+every enrollee. on refresh only the enrollees whose files changed are updated in the index.
+with SPEECHLIB_INDEX_LISTS set, the IVF lists are trained when the index is built and saved
+with it; an index saved with another number of lists is rebuilt from the stored embeddings,
+and SPEECHLIB_INDEX_PROBE applies to a loaded index as well.
+the folder is listed again at most every REFRESH_SECONDS, so rosters of thousands of speakers
+are not walked for every file.
+'''
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = ".voiceprints"
+MANIFEST_VERSION = 1
+
+REFRESH_SECONDS = float(os.environ.get("SPEECHLIB_VOICES_REFRESH_SECONDS", 5))
+
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def list_voice_files(voices_folder):
+    '''
+    return [(speaker name, relative path)] for every enrollment file in voices_folder
+    '''
+    voice_files = []
+    for speaker in sorted(os.listdir(voices_folder)):
+        speaker_path = os.path.join(voices_folder, speaker)
+        # skip the store itself and anything that is not a speaker folder
+        if speaker.startswith(".") or not os.path.isdir(speaker_path):
+            continue
+
+        for voice in sorted(os.listdir(speaker_path)):
+            if os.path.isfile(os.path.join(speaker_path, voice)):
+                voice_files.append((speaker.split(".")[0], os.path.join(speaker, voice)))
+
+    return voice_files
+
+
+def _files_by_speaker(files):
+    # {speaker: sorted (path, sha1) of its files}, to find the enrollees whose files changed
+    by_speaker = defaultdict(list)
+    for entry in files:
+        by_speaker[entry["speaker"]].append((entry["path"], entry["sha1"]))
+    return {speaker: sorted(entries) for speaker, entries in by_speaker.items()}
+
+
+def _files_digest(files):
+    # identifies the enrollment files an index was built from
+    return hashlib.sha1(json.dumps(sorted((entry["speaker"], entry["path"], entry["sha1"]) for entry in files)).encode("utf-8")).hexdigest()
+
+
+def voices_fingerprint(voices_folder):
+    '''
+    hash of the speaker names, paths, sizes and mtimes of the enrollment files (no file is read).
+    changes whenever a sample is added, removed, renamed or modified
+    '''
+    sha1 = hashlib.sha1()
+    for speaker, rel_path in list_voice_files(voices_folder):
+        stat = os.stat(os.path.join(voices_folder, rel_path))
+        sha1.update(f"{speaker}\0{rel_path}\0{stat.st_size}\0{stat.st_mtime}\n".encode("utf-8"))
+    return sha1.hexdigest()
+
+
+class VoiceprintStore:
+
+    def __init__(self, voices_folder, embed_file, model="speechbrain/spkrec-ecapa-voxceleb"):
+        '''
+        voices_folder: folder containing subfolders named after each speaker with voice samples
+
+        embed_file: function taking a wav path and returning a 1-D embedding
+
+        model: name of the embedding model. a store built with another model is rebuilt
+        '''
+        self.voices_folder = voices_folder
+        self.embed_file = embed_file
+        self.model = model
+        self.store_dir = os.path.join(voices_folder, STORE_DIR)
+        self.manifest_path = os.path.join(self.store_dir, "manifest.json")
+        self.embeddings_path = os.path.join(self.store_dir, "embeddings.npy")
+        self.index_path = os.path.join(self.store_dir, "index.npz")
+
+        self.files = []             # manifest entries, one per embedding row
+        self.embeddings = None      # files x dim
+        self.index = None           # SpeakerIndex of the enrollee centroids
+        self.refreshed = None       # time.monotonic() of the last refresh
+        self._lock = threading.Lock()
+
+    @property
+    def speakers(self):
+        '''
+        enrollee names, in the order of the score columns
+        '''
+        return self.index.names if self.index is not None else []
+
+    @property
+    def centroids(self):
+        '''
+        speakers x dim, L2 normalized
+        '''
+        return self.index.matrix if self.index is not None else np.zeros((0, 0), dtype=np.float32)
+
+    def _load(self):
+        if not (os.path.exists(self.manifest_path) and os.path.exists(self.embeddings_path)):
+            return [], None
+
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") != MANIFEST_VERSION or manifest.get("model") != self.model:
+                return [], None
+            embeddings = np.load(self.embeddings_path, mmap_mode="r")
+            if len(embeddings) != len(manifest["files"]):
+                return [], None
+            return manifest["files"], embeddings
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning("voiceprint store is unreadable, rebuilding: %s", err)
+            return [], None
+
+    def _save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        # write to temporary files first so a crash never leaves a half written store
+        tmp_embeddings = self.embeddings_path + ".tmp.npy"
+        tmp_manifest = self.manifest_path + ".tmp"
+        np.save(tmp_embeddings, np.ascontiguousarray(self.embeddings, dtype=np.float32))
+        with open(tmp_manifest, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "model": self.model, "files": self.files}, f)
+        os.replace(tmp_embeddings, self.embeddings_path)
+        os.replace(tmp_manifest, self.manifest_path)
+
+    def _load_index(self, files):
+        # the saved index is only used if it was built from exactly these files
+        try:
+            index, meta = SpeakerIndex.load(self.index_path)
+        except Exception as err:
+            if os.path.exists(self.index_path):
+                logger.warning("speaker index is unreadable, rebuilding: %s", err)
+            return None
+        if meta != {"model": self.model, "files": _files_digest(files)}:
+            return None
+        if index.n_lists != INDEX_LISTS:
+            logger.info("speaker index has %d lists, rebuilding with %d", index.n_lists, INDEX_LISTS)
+            return None
+        index.n_probe = INDEX_PROBE
+        return index
+
+    def refresh(self, max_age=0):
+        '''
+        sync the store with voices_folder, embedding only new or changed files.
+        does nothing if the last refresh is less than max_age seconds old
+        '''
+        with self._lock:
+            if self.refreshed is not None and time.monotonic() - self.refreshed < max_age:
+                return self
+
+            if self.embeddings is None:
+                old_files, old_embeddings = self._load()
+                self.index = self._load_index(old_files)
+            else:
+                old_files, old_embeddings = self.files, self.embeddings
+            old_by_path = {entry["path"]: (row, entry) for row, entry in enumerate(old_files)}
+
+            files = []
+            rows = []
+            changed = False
+
+            for speaker, rel_path in list_voice_files(self.voices_folder):
+                path = os.path.join(self.voices_folder, rel_path)
+                stat = os.stat(path)
+                entry = {"path": rel_path, "speaker": speaker, "mtime": stat.st_mtime, "size": stat.st_size}
+
+                row, old = old_by_path.get(rel_path, (None, None))
+                if old is not None and old["speaker"] == speaker and old["size"] == stat.st_size:
+                    if old["mtime"] == stat.st_mtime:
+                        entry["sha1"] = old["sha1"]
+                        files.append(entry)
+                        rows.append(np.asarray(old_embeddings[row], dtype=np.float32))
+                        continue
+
+                    entry["sha1"] = _file_hash(path)
+                    if entry["sha1"] == old["sha1"]:
+                        # touched but not modified
+                        files.append(entry)
+                        rows.append(np.asarray(old_embeddings[row], dtype=np.float32))
+                        changed = True
+                        continue
+                else:
+                    entry["sha1"] = _file_hash(path)
+
+                try:
+                    embedding = np.asarray(self.embed_file(path), dtype=np.float32).reshape(-1)
+                except Exception as err:
+                    logger.warning("error occured while embedding %s: %s", path, err)
+                    continue
+
+                files.append(entry)
+                rows.append(embedding)
+                changed = True
+                incr("enrollment_embeddings_computed")
+
+            if len(files) != len(old_files):
+                changed = True
+
+            self.files = files
+            if changed or old_embeddings is None or not rows:
+                self.embeddings = np.stack(rows) if rows else np.zeros((0, 0), dtype=np.float32)
+            else:
+                # nothing changed, serve rows straight from the memory map
+                self.embeddings = old_embeddings
+
+            if changed:
+                self._save()
+
+            self._update_index(old_files)
+            self.refreshed = time.monotonic()
+
+        return self
+
+    def _update_index(self, old_files):
+        # only enrollees whose files were added, changed or removed are written to the index
+        if self.index is None:
+            self.index = SpeakerIndex()
+            old_by_speaker = {}
+        else:
+            old_by_speaker = _files_by_speaker(old_files)
+        by_speaker = _files_by_speaker(self.files)
+
+        dirty = [speaker for speaker in set(by_speaker) | set(old_by_speaker) if by_speaker.get(speaker) != old_by_speaker.get(speaker)]
+        if not dirty and not self.index.ensure_trained():
+            return
+
+        rows = defaultdict(list)
+        for row, entry in enumerate(self.files):
+            rows[entry["speaker"]].append(row)
+
+        names = []
+        centroids = []
+        for speaker in sorted(dirty):
+            if speaker in by_speaker:
+                names.append(speaker)
+                centroids.append(_normalize(np.asarray(self.embeddings[rows[speaker]], dtype=np.float32)).sum(axis=0))
+            elif speaker in self.index:
+                self.index.remove(speaker)
+        if names:
+            self.index.add_many(names, np.stack(centroids))
+        # train the IVF lists here rather than on the first search, so they are saved with the index
+        self.index.ensure_trained()
+
+        logger.info("speaker index updated: %d of %d enrollees changed", len(dirty), len(self.index))
+        self.index.save(self.index_path, {"model": self.model, "files": _files_digest(self.files)})
+
+    def score(self, embeddings):
+        '''
+        cosine similarity of each embedding (N x dim) against every enrollee, returns N x speakers
+        '''
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        if not self.speakers:
+            return np.zeros((len(embeddings), 0), dtype=np.float32)
+
+        return self.index.score(embeddings.reshape(len(embeddings), -1))
+
+    def search(self, embeddings, k=1):
+        '''
+        the k best enrollees of every embedding, (scores, speaker indices), see SpeakerIndex.search
+        '''
+        if self.index is None:
+            embeddings = np.atleast_2d(embeddings)
+            return np.full((len(embeddings), k), -np.inf, dtype=np.float32), np.full((len(embeddings), k), -1, dtype=np.int64)
+        return self.index.search(embeddings, k)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_voiceprint_store(voices_folder, embed_file, model="speechbrain/spkrec-ecapa-voxceleb", max_age=REFRESH_SECONDS):
+    '''
+    return the refreshed store for voices_folder, shared across calls in this process.
+    the folder is synced again when the last refresh is older than max_age seconds
+    '''
+    key = (os.path.abspath(voices_folder), model)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = VoiceprintStore(voices_folder, embed_file, model)
+    return store.refresh(max_age)
@@ -1,39 +1,124 @@
-import os
-from pydub import AudioSegment
-from .transcribe import (transcribe)
+import logging
+import numpy as np
+from functools import partial
+from .transcribe import (transcribe_batch, SAMPLE_RATE)
+from .audio_buffer import (AudioBuffer)
+from .segment_table import (SegmentTable)
+from .executor import (iter_ordered, default_workers)
+from .metrics import (span, incr)
 
-# segment according to speaker
-def wav_file_segmentation(file_name, segments, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key):
-    # Load the WAV file
-    audio = AudioSegment.from_file(file_name, format="wav")
-    trans = ""
+logger = logging.getLogger(__name__)
+
+def make_batches(lengths, batch_size, max_batch_seconds=None, in_order=False):
+    '''
+    group segment indices into batches of similar length so padding inside a batch stays small.
+    with in_order=True batches are consecutive segments instead, so results can be streamed in time order.
+    returns a list of index lists.
+    '''
+    order = np.arange(len(lengths)) if in_order else np.argsort(lengths, kind="stable")
+    max_batch_samples = max_batch_seconds * SAMPLE_RATE if max_batch_seconds else None
+
+    batches = []
+    batch = []
+    batch_samples = 0
+    for idx in order:
+        idx = int(idx)
+        if batch and (len(batch) >= batch_size or (max_batch_samples and batch_samples + lengths[idx] > max_batch_samples)):
+            batches.append(batch)
+            batch = []
+            batch_samples = 0
+        batch.append(idx)
+        batch_samples += lengths[idx]
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def transcribe_clips(clips, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size=8, num_workers=1):
+    '''
+    transcribe one batch of clips. if the batch fails, clips are retried one by one and
+    clips that still fail get None. runs inside pool workers, so it has to stay top-level.
+    '''
+    try:
+        return transcribe_batch(clips, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size, num_workers)
+    except Exception as err:
+        logger.warning("ERROR while transcribing batch, retrying segments one by one: %s", err)
 
     texts = []
+    for clip in clips:
+        try:
+            texts.append(transcribe_batch([clip], language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, 1, num_workers)[0])
+        except Exception as err:
+            incr("transcription_errors")
+            logger.warning("ERROR while transcribing: %s", err)
+            texts.append(None)
+    return texts
 
-    folder_name = "segments"
+def transcribe_segments(audio, segments, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size=8, concurrency=None, max_workers=None, on_batch=None):
+    '''
+    transcribe [start, end, ...] segments of an AudioBuffer.
+    returns one transcript per segment in the original order (None where transcription failed).
 
-    if not os.path.exists(folder_name):
-        os.makedirs(folder_name)
+    concurrency: "none", "thread" or "process" (see executor.py). max_workers bounds the pool size
 
-    i = 0
+    on_batch: called with (segment indices, transcripts) of every batch as soon as it is done. batches then hold
+    consecutive segments so early segments finish first
+    '''
+    clips = [audio.numpy(segment[0], segment[1], SAMPLE_RATE) for segment in segments]
 
-    for segment in segments:
+    if model_type == "assemblyAI":
+        # the async backend submits all segments of the job at once and bounds concurrency itself
+        batches = [list(range(len(clips)))] if clips else []
+        concurrency = None
+    else:
+        batches = make_batches([len(clip) for clip in clips], batch_size, in_order=on_batch is not None)
 
-        start = segment[0] * 1000   # start time in miliseconds
-        end = segment[1] * 1000     # end time in miliseconds
-        clip = audio[start:end]
-        i = i + 1
-        file = folder_name + "/" + "segment"+ str(i) + ".wav"
-        clip.export(file, format="wav")
+    num_workers = (max_workers or default_workers()) if concurrency == "thread" else 1
+    job = partial(transcribe_clips, language=language, modelSize=modelSize, model_type=model_type, quantization=quantization,
+                  custom_model_path=custom_model_path, hf_model_path=hf_model_path, aai_api_key=aai_api_key,
+                  batch_size=batch_size, num_workers=num_workers)
 
-        try:
-            trans = transcribe(file, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key)  
-            
-            # return -> [[start time, end time, transcript], [start time, end time, transcript], ..]
-            texts.append([segment[0], segment[1], trans])
-        except Exception as err:
-            print("ERROR while transcribing: ", err)
-        # Delete the WAV file after processing
-        os.remove(file)
+    trans = [None] * len(clips)
+    with span("asr", model_type=model_type, segments=len(clips)):
+        results = iter_ordered(job, [[clips[i] for i in batch] for batch in batches], concurrency, max_workers)
+        for batch, texts in zip(batches, results):
+            for i, text in zip(batch, texts):
+                trans[i] = text
+            if on_batch is not None:
+                on_batch(batch, texts)
+    incr("segments_transcribed", len(clips))
+
+    return trans
+
+# segment according to speaker
+def wav_file_segmentation(file_name, segments, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size=8, audio=None, concurrency=None, max_workers=None, on_segments=None):
+    '''
+    segments: SegmentTable (transcripts are stored in the table, which is returned)
+    or a [[start, end, ...], ...] list
+
+    on_segments: for a SegmentTable, called with the row ids of every batch once their transcripts are stored
+    '''
+    # decode the WAV file once (unless the caller already did) and slice segments in memory
+    if audio is None:
+        audio = AudioBuffer.from_file(file_name)
+
+    if isinstance(segments, SegmentTable):
+        on_batch = None
+        if on_segments is not None:
+            def on_batch(batch, texts):
+                segments.set_text(segments.id[batch], texts)
+                on_segments(segments.id[batch])
+
+        trans = transcribe_segments(audio, segments.rows(), language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size, concurrency, max_workers, on_batch)
+        segments.set_text(segments.id, trans)
+        return segments
+
+    trans = transcribe_segments(audio, segments, language, modelSize, model_type, quantization, custom_model_path, hf_model_path, aai_api_key, batch_size, concurrency, max_workers)
+
+    # return -> [[start time, end time, transcript], [start time, end time, transcript], ..]
+    texts = []
+    for segment, text in zip(segments, trans):
+        if text is not None:
+            texts.append([segment[0], segment[1], text])
 
     return texts
@@ -1,7 +1,15 @@
 from transformers import pipeline
+from .model_registry import (get_model)
+from .executor import (worker_replica)
+
+SINHALA_MODEL = "Ransaka/whisper-tiny-sinhala-20k-8k-steps-v2"
+
+def load_sinhala_pipeline():
+    return get_model("huggingface", SINHALA_MODEL, "default", "default",
+                     lambda: pipeline("automatic-speech-recognition", model=SINHALA_MODEL), worker_replica())
 
 def whisper_sinhala(file):
-    pipe = pipeline("automatic-speech-recognition", model="Ransaka/whisper-tiny-sinhala-20k-8k-steps-v2")
+    pipe = load_sinhala_pipeline()
     res = pipe(file)
     return res["text"]
 
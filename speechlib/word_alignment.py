@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import torch
+from .transcribe import (load_faster_whisper, load_whisper, SAMPLE_RATE, MODEL_SIZES)
+
+'''
+whole-file transcription strategy.
+
+instead of transcribing every diarized turn as its own clip, the whole file is decoded once with
+word timestamps, every word is assigned to the diarization turn it overlaps most, and the words
+of each turn are joined into its transcript. this replaces one model invocation per turn with a
+single streaming decode that keeps the full context.
+'''
+
+
+def transcribe_words(audio, language, modelSize, model_type, quantization=False, custom_model_path=None):
+    '''
+    transcribe a whole AudioBuffer with word timestamps.
+    returns (starts, ends, words) where starts/ends are float arrays in seconds
+    '''
+    if modelSize not in MODEL_SIZES:
+        raise Exception("only 'base', 'tiny', 'small', 'medium', 'large', 'large-v1', 'large-v2', 'large-v3' models are available.")
+
+    samples = audio.numpy(sample_rate=SAMPLE_RATE)
+    starts = []
+    ends = []
+    words = []
+
+    if model_type == "faster-whisper":
+        model = load_faster_whisper(modelSize, quantization)
+        if language not in model.supported_languages:
+            raise Exception("Language code not supported.\nThese are the supported languages:\n", model.supported_languages)
+
+        # segments is a generator, words are decoded as we go
+        segments, info = model.transcribe(samples, language=language, beam_size=5, word_timestamps=True)
+        for segment in segments:
+            for word in segment.words or []:
+                starts.append(word.start)
+                ends.append(word.end)
+                words.append(word.word)
+    elif model_type in ["whisper", "custom"]:
+        if model_type == "custom":
+            model = load_whisper(custom_model_path, download_root=os.path.dirname(custom_model_path) + "/")
+        else:
+            model = load_whisper(modelSize)
+
+        result = model.transcribe(samples, language=language, fp16=torch.cuda.is_available(), word_timestamps=True)
+        for segment in result["segments"]:
+            for word in segment.get("words", []):
+                starts.append(word["start"])
+                ends.append(word["end"])
+                words.append(word["word"])
+    else:
+        raise Exception(f"model_type {model_type} does not support whole-file transcription. use faster-whisper, whisper or custom")
+
+    return np.asarray(starts, dtype=np.float64), np.asarray(ends, dtype=np.float64), words
+
+
+def assign_words(word_starts, word_ends, turn_starts, turn_ends, chunk_size=4096):
+    '''
+    index of the turn each word overlaps most. words that overlap no turn go to the turn
+    with the closest midpoint. returns an int array (-1 when there are no turns)
+    '''
+    if not len(turn_starts):
+        return np.full(len(word_starts), -1, dtype=np.int64)
+
+    turn_middles = (turn_starts + turn_ends) / 2
+    assignment = np.empty(len(word_starts), dtype=np.int64)
+
+    # words x turns overlap matrix, computed in chunks of words to bound memory
+    for i in range(0, len(word_starts), chunk_size):
+        starts = word_starts[i:i + chunk_size, None]
+        ends = word_ends[i:i + chunk_size, None]
+        overlap = np.minimum(ends, turn_ends[None, :]) - np.maximum(starts, turn_starts[None, :])
+
+        best = np.argmax(overlap, axis=1)
+        no_overlap = overlap[np.arange(len(best)), best] <= 0
+        if no_overlap.any():
+            middles = (starts[no_overlap, 0] + ends[no_overlap, 0]) / 2
+            best[no_overlap] = np.argmin(np.abs(middles[:, None] - turn_middles[None, :]), axis=1)
+
+        assignment[i:i + chunk_size] = best
+
+    return assignment
+
+
+def align_words_to_segments(segments, word_starts, word_ends, words):
+    '''
+    fill the text column of a SegmentTable from timestamped words. turns without words get no text
+    '''
+    assignment = assign_words(word_starts, word_ends, segments.start, segments.end)
+
+    texts = [[] for _ in range(len(segments))]
+    for turn, word in zip(assignment, words):
+        if turn >= 0:
+            texts[turn].append(word)
+
+    segments.set_text(segments.id, ["".join(turn_words).strip() if turn_words else None for turn_words in texts])
+    return segments
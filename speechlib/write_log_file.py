@@ -1,7 +1,9 @@
 import os
 from datetime import datetime
-from pydub import AudioSegment
 import uuid
+import numpy as np
+from .audio_buffer import (AudioBuffer)
+from .segment_table import (SegmentTable)
 
 """
 This script processes speech segments extracted from an audio file, organizes them by speaker, 
@@ -29,7 +31,15 @@ This system is designed to efficiently categorize and store speech data while ma
 on the number of stored files per speaker.
 """
 
-def write_log_file(common_segments, log_folder, file_name, language):
+def write_log_file(common_segments, log_folder, file_name, language, audio=None):
+    '''
+    common_segments: SegmentTable, or a [[start, end, text, speaker], ...] list
+
+    returns the path of the log file
+    '''
+
+    if not isinstance(common_segments, SegmentTable):
+        common_segments = SegmentTable.from_list(common_segments)
 
     if not os.path.exists(log_folder):
         os.makedirs(log_folder)
@@ -51,10 +61,22 @@ def write_log_file(common_segments, log_folder, file_name, language):
     unidentified_speakers_folder = os.path.join(log_folder, "unidentified_speakers")
     os.makedirs(unidentified_speakers_folder, exist_ok=True)
 
+    # decode once for all speakers unless the caller already did
+    if audio is None:
+        audio = AudioBuffer.from_file(og_file_name)
+
     # Dictionary to store unique SPEAKER_XX → UUID mappings
     speaker_uuid_map = {}
 
-    for speaker in set(segment[3] for segment in common_segments):
+    # only segments that were transcribed are logged
+    transcribed = np.array([text is not None for text in common_segments.text], dtype=bool)
+    speaker_ids = {}
+    for speaker, ids in common_segments.ids_by_speaker().items():
+        ids = ids[transcribed[ids]]
+        if len(ids):
+            speaker_ids[speaker] = ids
+
+    for speaker in speaker_ids:
         if speaker.startswith("SPEAKER_"):
             if speaker not in speaker_uuid_map:
                 speaker_uuid_map[speaker] = str(uuid.uuid4())
@@ -67,9 +89,9 @@ def write_log_file(common_segments, log_folder, file_name, language):
         speaker_folder = os.path.join(unidentified_speakers_folder, speaker_uuid)
         os.makedirs(speaker_folder, exist_ok=True)
 
-        # Filter and sort segments by duration (longest first)
-        speaker_segments = [s for s in common_segments if s[3] == speaker]
-        speaker_segments = sorted(speaker_segments, key=lambda s: (s[1] - s[0]), reverse=True)
+        # sort segments by duration (longest first)
+        ids = speaker_ids[speaker]
+        ids = ids[np.argsort(-common_segments.duration[ids], kind="stable")]
 
         # Check how many files already exist
         existing_files = [
@@ -81,29 +103,27 @@ def write_log_file(common_segments, log_folder, file_name, language):
         if num_available_slots == 0:
             continue  # Skip if folder already has 4 files
 
-        audio = AudioSegment.from_file(og_file_name, format="wav")
-
         added_segments = 0  # Counter to track added segments for non-"SPEAKER_" speakers
 
-        for i, segment in enumerate(speaker_segments):
+        for i, row in enumerate(ids):
             if added_segments >= num_available_slots:
                 break  # Stop adding if we reach 4 files
 
-            start, end, text, _ = segment
+            start = float(common_segments.start[row])
+            end = float(common_segments.end[row])
+            text = common_segments.text[row]
             
             # If audio length is greater than 15 seconds, shorten to 15 seconds
             if end - start > 15:
                 end = start + 15
 
-            clip = audio[start * 1000 : end * 1000]
-
             # Name the longest segment "verification_sample.wav"
             if i == 0:
                 output_filename = "verification_sample.wav"
             else:
                 output_filename = f"{start}_{end}_{file_name}.wav"
 
-            clip.export(os.path.join(speaker_folder, output_filename), format="wav")
+            audio.export(os.path.join(speaker_folder, output_filename), start, end)
             added_segments += 1
 
             if text:
@@ -112,4 +132,6 @@ def write_log_file(common_segments, log_folder, file_name, language):
     lf.write(entry.encode('utf-8'))
     lf.close()
 
+    return log_file
+
     # -------------------------log file end-------------------------
\ No newline at end of file
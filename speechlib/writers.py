@@ -0,0 +1,226 @@
+import os
+import json
+import threading
+from datetime import datetime
+import numpy as np
+
+'''
+streaming output writers.
+
+every writer appends one finished segment at a time and flushes it, so a consumer can tail the
+file (or read it after a crash) while the rest of the job is still running. formats:
+
+jsonl: one {"start", "end", "speaker", "text"} object per line, plus "source_ids" (the ids of the
+diarized turns a segment was merged from) when turns were coalesced
+
+srt, vtt: subtitles, the speaker is prefixed to the cue text (a <v> voice tag in WebVTT)
+
+rttm: NIST speaker turns (SPEAKER file 1 start duration <NA> <NA> speaker <NA> <NA>). the
+orthography field holds the comma separated source ids of coalesced turns
+
+open_writers() names the files like the transcript log (<file>_<HHMMSS>_<language>.<format>)
+and knows every path before the first segment is written, so callers get the exact output paths
+instead of scanning the log folder.
+'''
+
+OUTPUT_FORMATS = ["jsonl", "srt", "vtt", "rttm"]
+
+
+def _timestamp(seconds, separator):
+    millis = int(round(max(0.0, float(seconds)) * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
+
+
+class SegmentWriter:
+    '''
+    base class of the writers. subclasses set extension and implement format()
+    '''
+
+    extension = None
+
+    def __init__(self, path, file_id=None):
+        '''
+        file_id: name of the recording (defaults to the output file name)
+        '''
+        self.path = path
+        self.file_id = file_id or os.path.splitext(os.path.basename(path))[0]
+        self.count = 0
+        self._file = open(path, "w", encoding="utf-8")
+        header = self.header()
+        if header:
+            self._file.write(header)
+            self._file.flush()
+
+    def header(self):
+        return ""
+
+    def format(self, start, end, text, speaker, source_ids=None):
+        raise NotImplementedError
+
+    def write(self, start, end, text, speaker, source_ids=None):
+        self.count += 1
+        self._file.write(self.format(float(start), float(end), text, speaker, source_ids))
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class JsonlWriter(SegmentWriter):
+
+    extension = "jsonl"
+
+    def format(self, start, end, text, speaker, source_ids=None):
+        record = {"start": start, "end": end, "speaker": speaker, "text": text}
+        if source_ids is not None:
+            record["source_ids"] = source_ids
+        return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+class SrtWriter(SegmentWriter):
+
+    extension = "srt"
+
+    def format(self, start, end, text, speaker, source_ids=None):
+        return f"{self.count}\n{_timestamp(start, ',')} --> {_timestamp(end, ',')}\n{speaker}: {text.strip()}\n\n"
+
+
+class VttWriter(SegmentWriter):
+
+    extension = "vtt"
+
+    def header(self):
+        return "WEBVTT\n\n"
+
+    def format(self, start, end, text, speaker, source_ids=None):
+        return f"{_timestamp(start, '.')} --> {_timestamp(end, '.')}\n<v {speaker}>{text.strip()}\n\n"
+
+
+class RttmWriter(SegmentWriter):
+
+    extension = "rttm"
+
+    def format(self, start, end, text, speaker, source_ids=None):
+        # fields are separated by spaces, so names with spaces are joined with "_"
+        speaker = "_".join(str(speaker).split())
+        sources = ",".join(str(source) for source in source_ids) if source_ids else "<NA>"
+        return f"SPEAKER {self.file_id} 1 {start:.3f} {end - start:.3f} {sources} <NA> {speaker} <NA> <NA>\n"
+
+
+_writers = {
+    "jsonl": JsonlWriter,
+    "srt": SrtWriter,
+    "vtt": VttWriter,
+    "rttm": RttmWriter,
+}
+
+
+def register_writer(output_format, writer_class):
+    '''
+    add an output format. writer_class is called with the output path and the recording's file_id
+    and must have path, write(start, end, text, speaker, source_ids=None) and close()
+    '''
+    _writers[output_format] = writer_class
+    if output_format not in OUTPUT_FORMATS:
+        OUTPUT_FORMATS.append(output_format)
+
+
+class SegmentWriters:
+    '''
+    a set of writers fed with the same segments. paths maps every format to its file
+    '''
+
+    def __init__(self, writers, paths=None):
+        self.writers = writers
+        self.paths = paths if paths is not None else {}
+        self.paths.update({output_format: writer.path for output_format, writer in writers.items()})
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        '''
+        call listener((start, end, text, speaker)) for every segment written from now on
+        '''
+        self.listeners.append(listener)
+
+    def write(self, start, end, text, speaker, source_ids=None):
+        with self._lock:
+            for writer in self.writers.values():
+                writer.write(start, end, text, speaker, source_ids)
+            for listener in self.listeners:
+                listener((float(start), float(end), text, speaker))
+
+    def write_segments(self, common_segments):
+        '''
+        write [[start, end, text, speaker(, source_ids)], ...], skipping segments without text
+        '''
+        for segment in common_segments:
+            if segment[2]:
+                self.write(*segment[:5])
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writers(output_formats, log_folder, file_name, language, paths=None):
+    '''
+    open one writer per format (a name or a list of names) in log_folder
+
+    paths: optional dict that receives the output paths, for callers that hand it out before the job starts
+    '''
+    if isinstance(output_formats, str):
+        output_formats = [output_formats]
+
+    os.makedirs(log_folder, exist_ok=True)
+    current_time = datetime.now().strftime('%H%M%S')
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+
+    writers = {}
+    try:
+        for output_format in output_formats:
+            if output_format not in _writers:
+                raise Exception(f"output format {output_format} is not supported. use one of {OUTPUT_FORMATS}")
+            writers[output_format] = _writers[output_format](os.path.join(log_folder, f"{base_name}_{current_time}_{language}.{output_format}"), base_name)
+    except Exception:
+        for writer in writers.values():
+            writer.close()
+        raise
+
+    return SegmentWriters(writers, paths)
+
+
+class OrderedEmitter:
+    '''
+    passes the rows of a SegmentTable to write(start, end, text, speaker, source_ids) in time order while
+    their transcripts arrive in any order. rows without text are skipped
+    '''
+
+    def __init__(self, segments, write):
+        self.segments = segments
+        self.write = write
+        self.order = np.argsort(segments.start, kind="stable")
+        self.done = np.zeros(len(segments), dtype=bool)
+        self.next = 0
+
+    def __call__(self, ids):
+        '''
+        mark the row ids as transcribed and write every row that is now next in time order
+        '''
+        self.done[np.asarray(ids, dtype=np.int64)] = True
+        while self.next < len(self.order) and self.done[self.order[self.next]]:
+            i = self.order[self.next]
+            if self.segments.text[i]:
+                self.write(float(self.segments.start[i]), float(self.segments.end[i]), self.segments.text[i], self.segments.speaker_of(i),
+                           self.segments.source_ids(i))
+            self.next += 1